@@ -0,0 +1,275 @@
+import json
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+from migrate import apply_migrations
+
+# Runs EXPLAIN for every hot query against a seeded throw-away database and
+# fails if the planner falls back to a sequential scan on the listed table.
+#
+#   PLAN_CHECK_DATABASE_URL=postgresql://localhost/starearn_plan_check python check_query_plans.py
+
+SEED_USERS = int(os.getenv("PLAN_CHECK_SEED_USERS", "200000"))
+
+HOT_QUERIES = [
+    (
+        "leaderboard",
+        "users",
+        """
+        SELECT first_name, username, COALESCE(tickets, 0) AS stars
+        FROM users
+        ORDER BY stars DESC, user_id ASC
+        LIMIT 10
+        """,
+        (),
+    ),
+    (
+        "place_next_temp_order",
+        "sponsor_orders",
+        """
+        SELECT id, channel_username
+        FROM sponsor_orders
+        WHERE status = 'approved'
+          AND placed_in_slot = FALSE
+          AND channel_username IS NOT NULL
+        ORDER BY priority_level DESC, created_at ASC
+        LIMIT 1
+        """,
+        (),
+    ),
+    (
+        "fortune_spins_by_user",
+        "fortune_spins",
+        """
+        SELECT spin_id, prize_code, created_at
+        FROM fortune_spins
+        WHERE user_id = %s
+        ORDER BY created_at DESC
+        LIMIT 20
+        """,
+        (4242,),
+    ),
+    (
+        "exchange_requests_by_status",
+        "exchange_requests",
+        """
+        SELECT id, user_id, exchange_type, stars_amount
+        FROM exchange_requests
+        WHERE status = 'new'
+        ORDER BY created_at
+        LIMIT 50
+        """,
+        (),
+    ),
+    (
+        "referrals_by_referred",
+        "referrals",
+        "SELECT referrer_id FROM referrals WHERE referred_id = %s",
+        (4242,),
+    ),
+    (
+        "referrals_by_referrer",
+        "referrals",
+        "SELECT referred_id, COALESCE(is_valid, FALSE), inactive_since FROM referrals WHERE referrer_id = %s",
+        (4242,),
+    ),
+    (
+        "referrals_stalest_first",
+        "referrals",
+        """
+        SELECT referrer_id, referred_id
+        FROM referrals
+        WHERE checked_at IS NULL OR checked_at < NOW() - INTERVAL '30 minutes'
+        ORDER BY checked_at NULLS FIRST
+        LIMIT 100
+        """,
+        (),
+    ),
+    (
+        "broadcast_segment_seen",
+        "users",
+        "SELECT COUNT(*) FROM users WHERE last_seen >= NOW() - INTERVAL '7 days'",
+        (),
+    ),
+    (
+        "broadcast_segment_activated_seen",
+        "users",
+        "SELECT COUNT(*) FROM users WHERE activated = TRUE AND last_seen >= NOW() - INTERVAL '3 days'",
+        (),
+    ),
+    (
+        "broadcast_segment_level",
+        "users",
+        "SELECT COUNT(*) FROM users WHERE COALESCE(active_ref_count, 0) >= 12",
+        (),
+    ),
+    (
+        "users_reachable_walk",
+        "users",
+        "SELECT user_id FROM users WHERE user_id > %s AND is_reachable = TRUE ORDER BY user_id LIMIT 500",
+        (4242,),
+    ),
+    (
+        "outbox_due",
+        "outbound_messages",
+        """
+        SELECT id, chat_id, text, parse_mode, reply_markup, attempts
+        FROM outbound_messages
+        WHERE status = 'pending' AND next_attempt_at <= NOW()
+        ORDER BY next_attempt_at, id
+        LIMIT 50
+        """,
+        (),
+    ),
+    (
+        "user_state",
+        "users",
+        "SELECT COALESCE(tickets, 0), last_fortune_time FROM users WHERE user_id = %s",
+        (4242,),
+    ),
+]
+
+
+def seed(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM users")
+        if int(cur.fetchone()[0]) >= SEED_USERS:
+            return
+
+        print(f"Seeding {SEED_USERS} users...")
+        cur.execute(
+            """
+            INSERT INTO users (user_id, username, first_name, referrer_id, tickets, activated, last_seen)
+            SELECT
+                g,
+                'user' || g,
+                'User ' || g,
+                CASE WHEN g > 10 THEN (g * 7919) %% (g - 1) + 1 END,
+                (random() * 1000)::int,
+                random() < 0.3,
+                NOW() - (random() * INTERVAL '90 days')
+            FROM generate_series(1, %s) AS g
+            ON CONFLICT (user_id) DO NOTHING
+            """,
+            (SEED_USERS,),
+        )
+        cur.execute(
+            """
+            INSERT INTO referrals (referrer_id, referred_id, is_valid, checked_at)
+            SELECT referrer_id, user_id, random() < 0.5, NOW() - (random() * INTERVAL '30 days')
+            FROM users
+            WHERE referrer_id IS NOT NULL
+            ON CONFLICT (referrer_id, referred_id) DO NOTHING
+            """
+        )
+        cur.execute(
+            """
+            INSERT INTO fortune_spins (spin_id, user_id, prize_code, created_at)
+            SELECT md5(g::text), (g %% %s) + 1, 'star_1', NOW() - (g || ' seconds')::interval
+            FROM generate_series(1, %s) AS g
+            ON CONFLICT (spin_id) DO NOTHING
+            """,
+            (SEED_USERS, SEED_USERS * 3),
+        )
+        cur.execute(
+            """
+            INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount, status)
+            SELECT (g %% %s) + 1, 'user' || g, 'withdraw', 700,
+                   CASE WHEN g %% 500 = 0 THEN 'new' ELSE 'done' END
+            FROM generate_series(1, %s) AS g
+            """,
+            (SEED_USERS, SEED_USERS // 2),
+        )
+        cur.execute(
+            """
+            INSERT INTO sponsor_orders (user_id, username, channel_username, stars_amount, status, placed_in_slot, priority_level)
+            SELECT (g %% %s) + 1, 'user' || g, '@channel' || g, 200,
+                   CASE WHEN g %% 200 = 0 THEN 'approved' ELSE 'completed' END,
+                   g %% 200 <> 0,
+                   (g %% 2)
+            FROM generate_series(1, %s) AS g
+            """,
+            (SEED_USERS, SEED_USERS // 4),
+        )
+        cur.execute(
+            """
+            INSERT INTO outbound_messages (chat_id, text, kind, status, attempts, next_attempt_at, created_at, sent_at)
+            SELECT (g %% %s) + 1, 'message ' || g, 'other',
+                   CASE WHEN g %% 500 = 0 THEN 'pending' ELSE 'sent' END,
+                   CASE WHEN g %% 500 = 0 THEN g %% 3 ELSE 1 END,
+                   NOW() + ((g %% 7) - 3) * INTERVAL '1 minute',
+                   NOW() - (g || ' seconds')::interval,
+                   CASE WHEN g %% 500 = 0 THEN NULL ELSE NOW() - (g || ' seconds')::interval END
+            FROM generate_series(1, %s) AS g
+            """,
+            (SEED_USERS, SEED_USERS),
+        )
+    conn.commit()
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+    finally:
+        conn.autocommit = False
+
+
+def find_seq_scans(plan, relation):
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") == relation:
+        found.append(plan)
+    for child in plan.get("Plans", []):
+        found.extend(find_seq_scans(child, relation))
+    return found
+
+
+def check_plans(conn):
+    failures = []
+    with conn.cursor() as cur:
+        for name, relation, sql, params in HOT_QUERIES:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            raw = cur.fetchone()[0]
+            plan = (raw if isinstance(raw, list) else json.loads(raw))[0]["Plan"]
+
+            if find_seq_scans(plan, relation):
+                failures.append(name)
+                print(f"FAIL {name}: sequential scan on {relation}")
+            else:
+                print(f"ok   {name}")
+    conn.rollback()
+    return failures
+
+
+def main():
+    load_dotenv()
+
+    database_url = os.getenv("PLAN_CHECK_DATABASE_URL")
+    if not database_url:
+        print("PLAN_CHECK_DATABASE_URL is not set (use a disposable local database)")
+        return 2
+
+    if database_url == (os.getenv("DATABASE_URL") or os.getenv("MY_DATABASE_URL")):
+        print("PLAN_CHECK_DATABASE_URL must not point at the bot's database")
+        return 2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        apply_migrations(conn)
+        seed(conn)
+        failures = check_plans(conn)
+    finally:
+        conn.close()
+
+    if failures:
+        print(f"{len(failures)} hot query(ies) fell back to a sequential scan")
+        return 1
+
+    print("All hot queries use indexes.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used_at = time.monotonic()
+        self.prepared_statements = set()
+
+
+class PreparedStatements:
+    # Named server-side statements, PREPAREd on first use on each pooled
+    # connection and EXECUTEd afterwards. PREPARE is not undone by ROLLBACK,
+    # so the per-connection bookkeeping stays valid across failed transactions.
+    # Disable for PgBouncer in transaction mode: a PREPARE lives in one server
+    # session and the next transaction may land on another one.
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._statements = {}
+
+    def register(self, name, sql):
+        parts = sql.split("%s")
+        numbered = parts[0]
+        for i, part in enumerate(parts[1:], 1):
+            numbered += f"${i}{part}"
+        self._statements[name] = (sql, numbered, len(parts) - 1)
+
+    def _prepare(self, cur, name):
+        _, numbered, _ = self._statements[name]
+        cur.execute(f"PREPARE {name} AS {numbered}")
+        cur.connection.prepared_statements.add(name)
+
+    def execute(self, cur, name, params=()):
+        sql, _, param_count = self._statements[name]
+
+        if not self.enabled or not isinstance(cur.connection, PooledConnection):
+            cur.execute(sql, params)
+            return
+
+        if name not in cur.connection.prepared_statements:
+            self._prepare(cur, name)
+
+        if param_count:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * param_count)})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+
+class ConnectionPool:
+    def __init__(self, dsn, maxconn=10, timeout=5.0, healthcheck_after=30.0, **connect_kwargs):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+
+        self._counters = {
+            "created": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "saturated": 0,
+            "healthcheck_failures": 0,
+            "discarded": 0,
+        }
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.dsn,
+            connection_factory=PooledConnection,
+            **self.connect_kwargs,
+        )
+        with self._cond:
+            self._counters["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        if time.monotonic() - conn.last_used_at < self.healthcheck_after:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn = None
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+
+            if not self._idle and self._size >= self.maxconn:
+                self._counters["saturated"] += 1
+
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"no free database connection within {self.timeout:.1f}s "
+                        f"(pool size {self.maxconn})"
+                    )
+
+                self._counters["waits"] += 1
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - started
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._in_use += 1
+            self._counters["checkouts"] += 1
+
+        if conn is not None and not self._is_healthy(conn):
+            with self._cond:
+                self._counters["healthcheck_failures"] += 1
+                self._counters["discarded"] += 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._release_slot()
+                raise
+
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._counters["discarded"] += 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            else:
+                conn.last_used_at = time.monotonic()
+                self._idle.append(conn)
+
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except BaseException as e:
+            discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._counters)
+            data.update(
+                {
+                    "max": self.maxconn,
+                    "size": self._size,
+                    "in_use": self._in_use,
+                    "idle": len(self._idle),
+                    "saturation": self._in_use / self.maxconn if self.maxconn else 0.0,
+                    "wait_avg_ms": (
+                        self._wait_total / self._counters["checkouts"] * 1000
+                        if self._counters["checkouts"]
+                        else 0.0
+                    ),
+                    "wait_max_ms": self._wait_max * 1000,
+                }
+            )
+        return data
@@ -6,14 +6,14 @@ import hashlib
 import random
 import uuid
 from urllib.parse import parse_qsl
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
 from datetime import datetime, timedelta, timezone
 
 import psycopg2
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request
 from flask_cors import CORS
 
+from db_pool import ConnectionPool, PreparedStatements
+
 app = Flask(__name__)
 CORS(app)
 
@@ -26,6 +26,23 @@ if not DATABASE_URL:
 if not BOT_TOKEN:
     raise RuntimeError("No BOT_TOKEN in environment")
 
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+# Shared secret for operational endpoints; they are disabled while unset.
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+
+db_pool = ConnectionPool(
+    DATABASE_URL,
+    maxconn=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    healthcheck_after=DB_POOL_HEALTHCHECK_SECONDS,
+    connect_timeout=DB_CONNECT_TIMEOUT,
+)
+prepared_statements = PreparedStatements(enabled=DB_PREPARED_STATEMENTS)
+
 COOLDOWN_HOURS = 6
 SPIN_COST_STARS = 2
 
@@ -66,7 +83,21 @@ WELCOME_WEIGHTS = {
 
 
 def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+    conn = g.get("db_conn")
+    if conn is None:
+        conn = db_pool.getconn()
+        g.db_conn = conn
+    return conn
+
+
+@app.teardown_appcontext
+def release_conn(exc):
+    conn = g.pop("db_conn", None)
+    if conn is None:
+        return
+
+    discard = isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    db_pool.putconn(conn, discard=discard)
 
 
 def now_utc():
@@ -227,27 +258,33 @@ def get_wheel_weights_by_bonus(total_bonus_percent: int):
     return boosted
 
 
+prepared_statements.register(
+    "active_sponsors_all",
+    """
+    SELECT slot_no, sponsor_type, channel_username
+    FROM sponsor_slots
+    WHERE is_active = TRUE AND channel_username IS NOT NULL
+    ORDER BY slot_no
+    """,
+)
+prepared_statements.register(
+    "active_sponsors_main",
+    """
+    SELECT slot_no, sponsor_type, channel_username
+    FROM sponsor_slots
+    WHERE is_active = TRUE
+      AND sponsor_type = 'main'
+      AND channel_username IS NOT NULL
+    ORDER BY slot_no
+    """,
+)
+
+
 def get_active_sponsors(cur, include_temp=True):
     if include_temp:
-        cur.execute(
-            """
-            SELECT slot_no, sponsor_type, channel_username
-            FROM sponsor_slots
-            WHERE is_active = TRUE AND channel_username IS NOT NULL
-            ORDER BY slot_no
-            """
-        )
+        prepared_statements.execute(cur, "active_sponsors_all")
     else:
-        cur.execute(
-            """
-            SELECT slot_no, sponsor_type, channel_username
-            FROM sponsor_slots
-            WHERE is_active = TRUE
-              AND sponsor_type = 'main'
-              AND channel_username IS NOT NULL
-            ORDER BY slot_no
-            """
-        )
+        prepared_statements.execute(cur, "active_sponsors_main")
 
     rows = cur.fetchall()
     sponsors = []
@@ -262,25 +299,28 @@ def get_active_sponsors(cur, include_temp=True):
     return sponsors
 
 
+prepared_statements.register(
+    "spin_user_state",
+    """
+    SELECT
+        COALESCE(tickets, 0),
+        last_fortune_time,
+        COALESCE(all_subscribed, 0),
+        COALESCE(activated, FALSE),
+        COALESCE(active_ref_count, 0),
+        COALESCE(activation_bonus_percent, 0),
+        COALESCE(boost_percent, 0),
+        COALESCE(boost_spins_left, 0),
+        COALESCE(paid_spins, 0),
+        COALESCE(welcome_spin_used, FALSE)
+    FROM users
+    WHERE user_id = %s
+    """,
+)
+
+
 def get_user_state(cur, user_id: int):
-    cur.execute(
-        """
-        SELECT
-            COALESCE(tickets, 0),
-            last_fortune_time,
-            COALESCE(all_subscribed, 0),
-            COALESCE(activated, FALSE),
-            COALESCE(active_ref_count, 0),
-            COALESCE(activation_bonus_percent, 0),
-            COALESCE(boost_percent, 0),
-            COALESCE(boost_spins_left, 0),
-            COALESCE(paid_spins, 0),
-            COALESCE(welcome_spin_used, FALSE)
-        FROM users
-        WHERE user_id = %s
-        """,
-        (user_id,),
-    )
+    prepared_statements.execute(cur, "spin_user_state", (user_id,))
     row = cur.fetchone()
     if not row:
         return None
@@ -311,9 +351,9 @@ def get_user_state(cur, user_id: int):
     }
 
 
-
-
-def send_post_welcome_message(user_id: int, stars: int):
+def enqueue_post_welcome_message(cur, user_id: int, stars: int):
+    # Delivered by the bot's outbox dispatcher, so the response does not
+    # wait for the Bot API.
     text = (
         "🎉 <b>Приветственный спин получен!</b>\n\n"
         "Теперь откройте полный путь к <b>Звёздному Колесу</b>:\n"
@@ -331,25 +371,25 @@ def send_post_welcome_message(user_id: int, stars: int):
         ]
     }
 
-    payload = json.dumps({
-        "chat_id": user_id,
-        "text": text,
-        "parse_mode": "HTML",
-        "reply_markup": reply_markup,
-    }).encode("utf-8")
-
-    req = Request(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-        data=payload,
-        headers={"Content-Type": "application/json"},
-        method="POST",
+    cur.execute(
+        """
+        INSERT INTO outbound_messages (chat_id, text, parse_mode, reply_markup, kind)
+        VALUES (%s, %s, 'HTML', %s, 'welcome_spin')
+        """,
+        (user_id, text, json.dumps(reply_markup)),
     )
 
-    try:
-        with urlopen(req, timeout=10) as resp:
-            resp.read()
-    except Exception as e:
-        print(f"send_post_welcome_message error: {e}")
+
+def is_admin_request():
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_API_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode())
+
+
+@app.get("/api/db_pool")
+def db_pool_stats():
+    if not is_admin_request():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify({"ok": True, "pool": db_pool.stats()})
 
 
 @app.post("/api/me")
@@ -458,10 +498,9 @@ def welcome_spin():
 
             row = cur.fetchone()
             new_stars = int((row[0] or 0) if row else 0)
+            enqueue_post_welcome_message(cur, user_id, new_stars)
             conn.commit()
 
-            send_post_welcome_message(user_id, new_stars)
-
             return jsonify(
                 {
                     "ok": True,
@@ -756,6 +795,30 @@ def buy_spin():
             )
 
 
+SPIN_CODES = ["nothing", "star_1", "star_2", "star_3", "star_4", "star_5"]
+LEVEL_MIN_REFS = [12, 8, 4, 0]
+
+prepared_statements.register(
+    "spin_wheel",
+    """
+    SELECT
+        spin_status,
+        spin_prize,
+        spin_add_stars,
+        new_tickets,
+        new_paid_spins,
+        new_boost_percent,
+        new_boost_spins_left,
+        user_activation_bonus,
+        user_ref_count,
+        user_total_bonus,
+        wait_seconds,
+        sponsor_names
+    FROM spin_wheel(%s, %s, %s, %s, %s, %s::text[], %s::float8[], %s::int[], %s::int[], %s::int[])
+    """,
+)
+
+
 @app.post("/api/spin")
 def spin():
     user_id, error_response, status_code = resolve_webapp_user_id()
@@ -763,156 +826,84 @@ def spin():
         return error_response, status_code
     now = now_utc()
     cooldown = timedelta(hours=COOLDOWN_HOURS)
+    spin_id = str(uuid.uuid4())
 
     with get_conn() as conn:
         with conn.cursor() as cur:
-            state = get_user_state(cur, user_id)
-            if state is None:
-                return jsonify({"ok": False, "error": "user_not_found"}), 404
-
-            sponsors = get_active_sponsors(cur, include_temp=True)
-            main_sponsors = get_active_sponsors(cur, include_temp=False)
-
-            if not main_sponsors:
-                return jsonify(
-                    {
-                        "ok": False,
-                        "error": "not_configured",
-                        "message": "Основные спонсоры ещё не настроены.",
-                    }
-                ), 200
-
-            if state["all_subscribed"] != 1:
-                sponsor_names = ", ".join([s["channel_username"] for s in sponsors]) if sponsors else "активных спонсоров"
-                return jsonify(
-                    {
-                        "ok": False,
-                        "error": "not_subscribed",
-                        "message": f"Нет подписки на всех активных спонсоров: {sponsor_names}",
-                    }
-                ), 200
-
-            if not state["activated"]:
-                return jsonify(
-                    {
-                        "ok": False,
-                        "error": "not_activated",
-                        "message": "Колесо ещё не активировано. Подпишитесь на 2 основных спонсоров и обновите статус.",
-                    }
-                ), 200
-
-            last_time = state["last_time"]
-            free_spin_ready = (last_time is None) or ((now - last_time) >= cooldown)
-            use_paid_spin = False
-
-            if not free_spin_ready:
-                if state.get("paid_spins", 0) > 0:
-                    use_paid_spin = True
-                else:
-                    remaining = cooldown - (now - last_time)
-                    wait_seconds = max(0, int(remaining.total_seconds()))
-                    return jsonify(
-                        {
-                            "ok": False,
-                            "error": "cooldown",
-                            "wait_seconds": wait_seconds,
-                            "paid_spins": state.get("paid_spins", 0),
-                        }
-                    ), 200
-
-            level = get_level_info(state["ref_count"])
-            total_bonus_percent = int(state.get("activation_bonus_percent", 0)) + int(level["bonus_percent"]) + int(state.get("boost_percent", 0))
-            weights_dict = get_wheel_weights_by_bonus(total_bonus_percent)
-
-            codes = ["nothing", "star_1", "star_2", "star_3", "star_4", "star_5"]
-            weights = [
-                weights_dict["nothing"],
-                weights_dict["star_1"],
-                weights_dict["star_2"],
-                weights_dict["star_3"],
-                weights_dict["star_4"],
-                weights_dict["star_5"],
-            ]
+            prepared_statements.execute(
+                cur,
+                "spin_wheel",
+                (
+                    user_id,
+                    spin_id,
+                    now,
+                    cooldown,
+                    random.random(),
+                    SPIN_CODES,
+                    [BASE_WEIGHTS[code] for code in SPIN_CODES],
+                    [PRIZE_TO_STARS.get(code, 0) for code in SPIN_CODES],
+                    LEVEL_MIN_REFS,
+                    [get_level_info(refs)["bonus_percent"] for refs in LEVEL_MIN_REFS],
+                ),
+            )
+            (
+                status,
+                prize_code,
+                add_stars,
+                new_stars,
+                new_paid_spins,
+                new_boost_percent,
+                new_boost_spins_left,
+                activation_bonus_percent,
+                ref_count,
+                total_bonus_percent,
+                wait_seconds,
+                sponsor_names,
+            ) = cur.fetchone()
+
+    if status == "user_not_found":
+        return jsonify({"ok": False, "error": "user_not_found"}), 404
+
+    if status == "not_configured":
+        return jsonify(
+            {
+                "ok": False,
+                "error": "not_configured",
+                "message": "Основные спонсоры ещё не настроены.",
+            }
+        ), 200
 
-            prize_code = random.choices(codes, weights=weights, k=1)[0]
-            base_stars = PRIZE_TO_STARS.get(prize_code, 0)
-            add_stars = base_stars
-            spin_id = str(uuid.uuid4())
+    if status == "not_subscribed":
+        sponsor_names = sponsor_names or "активных спонсоров"
+        return jsonify(
+            {
+                "ok": False,
+                "error": "not_subscribed",
+                "message": f"Нет подписки на всех активных спонсоров: {sponsor_names}",
+            }
+        ), 200
 
-            cur.execute(
-                """
-                INSERT INTO fortune_spins (spin_id, user_id, prize_code, created_at)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (spin_id, user_id, prize_code, now),
-            )
+    if status == "not_activated":
+        return jsonify(
+            {
+                "ok": False,
+                "error": "not_activated",
+                "message": "Колесо ещё не активировано. Подпишитесь на 2 основных спонсоров и обновите статус.",
+            }
+        ), 200
 
-            new_boost_spins_left = int(state.get("boost_spins_left", 0))
-            new_boost_percent = int(state.get("boost_percent", 0))
-
-            if new_boost_spins_left > 0:
-                new_boost_spins_left -= 1
-                if new_boost_spins_left <= 0:
-                    new_boost_spins_left = 0
-                    new_boost_percent = 0
-
-            if use_paid_spin:
-                if add_stars > 0:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET tickets = COALESCE(tickets, 0) + %s,
-                            paid_spins = COALESCE(paid_spins, 0) - 1,
-                            boost_percent = %s,
-                            boost_spins_left = %s
-                        WHERE user_id = %s
-                        RETURNING tickets, paid_spins
-                        """,
-                        (add_stars, new_boost_percent, new_boost_spins_left, user_id),
-                    )
-                else:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET paid_spins = COALESCE(paid_spins, 0) - 1,
-                            boost_percent = %s,
-                            boost_spins_left = %s
-                        WHERE user_id = %s
-                        RETURNING tickets, paid_spins
-                        """,
-                        (new_boost_percent, new_boost_spins_left, user_id),
-                    )
-            else:
-                if add_stars > 0:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET tickets = COALESCE(tickets, 0) + %s,
-                            last_fortune_time = %s,
-                            boost_percent = %s,
-                            boost_spins_left = %s
-                        WHERE user_id = %s
-                        RETURNING tickets, paid_spins
-                        """,
-                        (add_stars, now, new_boost_percent, new_boost_spins_left, user_id),
-                    )
-                else:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET last_fortune_time = %s,
-                            boost_percent = %s,
-                            boost_spins_left = %s
-                        WHERE user_id = %s
-                        RETURNING tickets, paid_spins
-                        """,
-                        (now, new_boost_percent, new_boost_spins_left, user_id),
-                    )
+    if status == "cooldown":
+        return jsonify(
+            {
+                "ok": False,
+                "error": "cooldown",
+                "wait_seconds": int(wait_seconds or 0),
+                "paid_spins": int(new_paid_spins or 0),
+            }
+        ), 200
 
-            row = cur.fetchone()
-            new_stars = row[0]
-            new_paid_spins = row[1]
-            conn.commit()
+    level = get_level_info(int(ref_count or 0))
+    weights_dict = get_wheel_weights_by_bonus(int(total_bonus_percent or 0))
 
     return jsonify(
         {
@@ -920,16 +911,16 @@ def spin():
             "spin_id": spin_id,
             "prize": prize_code,
             "label": LABEL_MAP.get(prize_code, prize_code),
-            "add_stars": add_stars,
+            "add_stars": int(add_stars or 0),
             "stars": int(new_stars or 0),
             "level": level["name"],
             "level_emoji": level["emoji"],
             "bonus_percent": level["bonus_percent"],
-            "activation_bonus_percent": state.get("activation_bonus_percent", 0),
-            "boost_percent": new_boost_percent,
-            "boost_spins_left": new_boost_spins_left,
+            "activation_bonus_percent": int(activation_bonus_percent or 0),
+            "boost_percent": int(new_boost_percent or 0),
+            "boost_spins_left": int(new_boost_spins_left or 0),
             "paid_spins": int(new_paid_spins or 0),
-            "total_bonus_percent": total_bonus_percent,
+            "total_bonus_percent": int(total_bonus_percent or 0),
             "weights": weights_dict,
         }
     )
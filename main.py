@@ -1,9 +1,18 @@
 import os
 import asyncio
+import contextlib
+import functools
+import html
+import itertools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import psycopg2
 from dotenv import load_dotenv
+from psycopg2.extras import Json, execute_values
 
 from telegram import (
     Update,
@@ -15,8 +24,10 @@ from telegram import (
     WebAppInfo,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     Application,
+    ChatMemberHandler,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
@@ -24,10 +35,72 @@ from telegram.ext import (
     filters,
 )
 
+from db_pool import ConnectionPool, PoolTimeout, PreparedStatements
+from rate_limiter import PRIORITY_BULK, BotRateLimiter
+from migrate import apply_migrations, get_schema_version, latest_version as latest_migration_version
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("MY_DATABASE_URL")
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL")
+
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "10"))
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+READ_REPLICA_MAX_LAG_SECONDS = float(os.getenv("READ_REPLICA_MAX_LAG_SECONDS", "30"))
+READ_REPLICA_CHECK_SECONDS = float(os.getenv("READ_REPLICA_CHECK_SECONDS", "15"))
+DB_STREAM_FETCH_SIZE = int(os.getenv("DB_STREAM_FETCH_SIZE", "2000"))
+
+HEARTBEAT_FLUSH_SECONDS = float(os.getenv("HEARTBEAT_FLUSH_SECONDS", "60"))
+
+SUBSCRIPTION_CACHE_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_POSITIVE_TTL", "300"))
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "30"))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("SUBSCRIPTION_CACHE_MAX_ENTRIES", "50000"))
+SUBSCRIPTION_STATE_MAX_AGE = float(os.getenv("SUBSCRIPTION_STATE_MAX_AGE", str(7 * 24 * 3600)))
+SUBSCRIPTION_STATE_NEGATIVE_MAX_AGE = float(os.getenv("SUBSCRIPTION_STATE_NEGATIVE_MAX_AGE", "900"))
+
+SUBSCRIPTION_CHECK_CONCURRENCY = int(os.getenv("SUBSCRIPTION_CHECK_CONCURRENCY", "10"))
+CHANNEL_BREAKER_FAILURES = int(os.getenv("CHANNEL_BREAKER_FAILURES", "5"))
+CHANNEL_BREAKER_PROBE_SECONDS = float(os.getenv("CHANNEL_BREAKER_PROBE_SECONDS", "300"))
+
+REFERRAL_FRESHNESS_SECONDS = float(os.getenv("REFERRAL_FRESHNESS_SECONDS", "1800"))
+# Queued referrers (the user pressed "🔄 Обновить статус") only skip referrals
+# checked within this window, so repeated presses do not repeat the calls.
+REFERRAL_PRIORITY_FRESHNESS_SECONDS = float(os.getenv("REFERRAL_PRIORITY_FRESHNESS_SECONDS", "60"))
+REFERRAL_RECHECK_INTERVAL_SECONDS = float(os.getenv("REFERRAL_RECHECK_INTERVAL_SECONDS", "60"))
+REFERRAL_RECHECK_BUDGET_PER_MINUTE = int(os.getenv("REFERRAL_RECHECK_BUDGET_PER_MINUTE", "300"))
+REFERRAL_RECHECK_BATCH = int(os.getenv("REFERRAL_RECHECK_BATCH", "100"))
+
+ORDER_RECOUNT_INTERVAL_SECONDS = float(os.getenv("ORDER_RECOUNT_INTERVAL_SECONDS", "30"))
+ORDER_RECOUNT_CHUNK_SIZE = int(os.getenv("ORDER_RECOUNT_CHUNK_SIZE", "500"))
+
+BROADCAST_TICK_SECONDS = float(os.getenv("BROADCAST_TICK_SECONDS", "5"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+OUTBOX_TICK_SECONDS = float(os.getenv("OUTBOX_TICK_SECONDS", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "10"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+
+SPONSOR_AUDIT_INTERVAL_SECONDS = float(os.getenv("SPONSOR_AUDIT_INTERVAL_SECONDS", "10"))
+SPONSOR_AUDIT_CHUNK_SIZE = int(os.getenv("SPONSOR_AUDIT_CHUNK_SIZE", "200"))
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+TELEGRAM_PRIVATE_CHAT_RATE = float(os.getenv("TELEGRAM_PRIVATE_CHAT_RATE", "1"))
+TELEGRAM_PRIVATE_CHAT_BURST = int(os.getenv("TELEGRAM_PRIVATE_CHAT_BURST", "3"))
+TELEGRAM_GROUP_CHAT_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_CHAT_PER_MINUTE", "20"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
 
 ADMINS = [514167463]
 BOT_USERNAME_FOR_REFLINK = "StarEarnTG_bot"
@@ -201,10 +274,234 @@ FAQ_ITEMS = {
 }
 
 
+class ReachabilityTracker:
+    # Users whose chats failed with Forbidden / "chat not found". Marks are
+    # collected here and written by flush_reachability(); forget() drops a
+    # pending mark when the user shows up again before the flush.
+
+    def __init__(self):
+        self._pending = {}
+        self.stats = {"marked": 0, "written": 0, "cleared": 0, "errors": 0}
+
+    def mark_unreachable(self, user_id: int, ts=None):
+        if user_id not in self._pending:
+            self.stats["marked"] += 1
+        self._pending[user_id] = ts or utcnow()
+
+    def forget(self, user_id: int):
+        self._pending.pop(user_id, None)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def drain(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        for user_id, ts in pending.items():
+            self._pending.setdefault(user_id, ts)
+
+
+reachability = ReachabilityTracker()
+
+telegram_rate_limiter = BotRateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    global_burst=TELEGRAM_GLOBAL_BURST,
+    private_rate=TELEGRAM_PRIVATE_CHAT_RATE,
+    private_burst=TELEGRAM_PRIVATE_CHAT_BURST,
+    group_per_minute=TELEGRAM_GROUP_CHAT_PER_MINUTE,
+    max_retries=TELEGRAM_MAX_RETRIES,
+    on_unreachable=reachability.mark_unreachable,
+)
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+prepared_statements = PreparedStatements(enabled=DB_PREPARED_STATEMENTS)
+
+
+def _create_pool(dsn):
+    return ConnectionPool(
+        dsn,
+        maxconn=DB_POOL_MAX,
+        timeout=DB_POOL_TIMEOUT,
+        healthcheck_after=DB_POOL_HEALTHCHECK_SECONDS,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        options=f"-c statement_timeout={int(DB_QUERY_TIMEOUT * 1000)}",
+        # A dead server connection surfaces as an error instead of a run_db
+        # call that never returns.
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+
+
+def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL is not set")
+                _db_pool = _create_pool(DATABASE_URL)
+    return _db_pool
+
+
 def get_db_connection():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    return psycopg2.connect(DATABASE_URL)
+    return get_db_pool().connection()
+
+
+_read_pool = None
+_replica_lock = threading.Lock()
+replica_state = {
+    "healthy": False,
+    "lag_seconds": None,
+    "checked_at": 0.0,
+    "last_error": None,
+    "reads": 0,
+    "fallbacks": 0,
+}
+
+
+def get_read_pool():
+    global _read_pool
+    if _read_pool is None:
+        with _replica_lock:
+            if _read_pool is None:
+                _read_pool = _create_pool(READ_DATABASE_URL)
+    return _read_pool
+
+
+def _check_replica():
+    # Lag is "now - last replayed commit" only while the replica still has WAL
+    # to replay; a caught-up replica of an idle primary would otherwise look
+    # further and further behind.
+    with get_read_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            """)
+            return float(cur.fetchone()[0])
+
+
+def replica_available():
+    if not READ_DATABASE_URL:
+        return False
+
+    with _replica_lock:
+        if time.monotonic() - replica_state["checked_at"] < READ_REPLICA_CHECK_SECONDS:
+            return replica_state["healthy"]
+        replica_state["checked_at"] = time.monotonic()
+
+    try:
+        lag = _check_replica()
+        healthy = lag <= READ_REPLICA_MAX_LAG_SECONDS
+        error = None if healthy else f"lag {lag:.1f}s"
+    except Exception as e:
+        lag = None
+        healthy = False
+        error = str(e)
+
+    with _replica_lock:
+        replica_state["healthy"] = healthy
+        replica_state["lag_seconds"] = lag
+        replica_state["last_error"] = error
+    return healthy
+
+
+def _mark_replica_unhealthy(error):
+    with _replica_lock:
+        replica_state["healthy"] = False
+        replica_state["checked_at"] = time.monotonic()
+        replica_state["last_error"] = str(error)
+
+
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_POOL_MAX * (2 if READ_DATABASE_URL else 1),
+    thread_name_prefix="db",
+)
+
+
+def _run_in_transaction(pool, func, args, kwargs, timeout, read_only=False):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            if read_only:
+                cur.execute("SET TRANSACTION READ ONLY")
+            if timeout != DB_QUERY_TIMEOUT:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(timeout * 1000),))
+            return func(cur, *args, **kwargs)
+
+
+def _run_db_transaction(func, args, kwargs, timeout, replica=False, queued_until=None):
+    if queued_until is not None and time.monotonic() > queued_until:
+        raise PoolTimeout(f"database executor queue wait exceeded {DB_POOL_TIMEOUT:.1f}s")
+
+    if replica and replica_available():
+        try:
+            result = _run_in_transaction(get_read_pool(), func, args, kwargs, timeout, read_only=True)
+            with _replica_lock:
+                replica_state["reads"] += 1
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout) as e:
+            print("read replica error, falling back to primary:", e)
+            _mark_replica_unhealthy(e)
+
+    if replica and READ_DATABASE_URL:
+        with _replica_lock:
+            replica_state["fallbacks"] += 1
+
+    return _run_in_transaction(get_db_pool(), func, args, kwargs, timeout)
+
+
+async def run_db(func, *args, timeout=DB_QUERY_TIMEOUT, replica=False, **kwargs):
+    # func(cur, *args, **kwargs) runs in one transaction on a pooled connection
+    # inside db_executor, so the event loop never waits on psycopg2.
+    # replica=True sends read-only work to READ_DATABASE_URL while it is
+    # reachable and within READ_REPLICA_MAX_LAG_SECONDS, else to the primary.
+    # Statements are bounded only by the server-side statement_timeout
+    # (timeout), which rolls the transaction back, so a timeout error means
+    # nothing was committed. Waiting for an executor thread and a pool
+    # connection is bounded by DB_POOL_TIMEOUT each. Cancelling the awaiting
+    # task does not stop a transaction that has already started.
+    loop = asyncio.get_running_loop()
+    queued_until = time.monotonic() + DB_POOL_TIMEOUT
+    call = functools.partial(_run_db_transaction, func, args, kwargs, timeout, replica, queued_until)
+    return await loop.run_in_executor(db_executor, call)
+
+
+def _fetch_page(cur, sql, params, after, page_size):
+    cur.execute(sql, tuple(params) + (after, page_size))
+    return cur.fetchall()
+
+
+async def stream_rows(sql, params=(), fetch_size=DB_STREAM_FETCH_SIZE, replica=False, after=0):
+    # Async generator over keyset pages of at most fetch_size rows. sql must
+    # select the key first and end with "<key> > %s ORDER BY <key> LIMIT %s";
+    # those two parameters are appended to params. Every page is its own
+    # short run_db call, so no connection or snapshot is held between pages
+    # and the first page comes back without scanning the rest.
+    while True:
+        rows = await run_db(_fetch_page, sql, params, after, fetch_size, replica=replica)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < fetch_size:
+            return
+        after = rows[-1][0]
+
+
+def close_db_pool():
+    db_executor.shutdown(wait=True)
+    if _db_pool is not None:
+        _db_pool.closeall()
+    if _read_pool is not None:
+        _read_pool.closeall()
 
 
 def utcnow():
@@ -236,20 +533,505 @@ def normalize_channel_username(channel: str) -> str:
     return channel
 
 
+def _enqueue_messages(cur, messages, kind, parse_mode=ParseMode.HTML):
+    # messages: [(chat_id, text)]. Call inside the transaction that makes
+    # the change the message is about, so both commit or neither does.
+    if not messages:
+        return
+    execute_values(
+        cur,
+        "INSERT INTO outbound_messages (chat_id, text, parse_mode, kind) VALUES %s",
+        [(chat_id, text, str(parse_mode) if parse_mode else None, kind) for chat_id, text in messages],
+    )
+
+
+async def enqueue_message(chat_id: int, text: str, kind: str):
+    try:
+        await run_db(_enqueue_messages, [(chat_id, text)], kind)
+    except Exception as e:
+        print("enqueue_message error:", e)
+
+
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE, text: str):
-    for admin_id in ADMINS:
+    try:
+        await run_db(_enqueue_messages, [(admin_id, text) for admin_id in ADMINS], "admin")
+    except Exception as e:
+        print("notify_admins error:", e)
+
+
+class SubscriptionCache:
+    # (user_id, channel) -> (is_member, expires_at). Positive results live
+    # longer than negative ones so a user who has just subscribed is picked
+    # up quickly; "🔄 Обновить статус" drops the negatives right away.
+
+    def __init__(self, positive_ttl, negative_ttl, max_entries):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    @staticmethod
+    def _key(user_id, channel):
+        return user_id, channel_key(channel)
+
+    def get(self, user_id, channel):
+        key = self._key(user_id, channel)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[0]
+
+        if entry is not None:
+            del self._entries[key]
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, user_id, channel, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        if ttl <= 0:
+            return
+
+        key = self._key(user_id, channel)
+        self._entries.pop(key, None)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+
+        if len(self._entries) > self.max_entries:
+            self._evict()
+
+    def _evict(self):
+        # Runs once the cache is full and frees down to 90% of max_entries,
+        # so the full scan is paid once per max_entries / 10 inserts rather
+        # than on every set(). Entries are in insertion order, oldest first.
+        low_water = int(self.max_entries * 0.9)
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry[1] <= now]
+        for key in expired:
+            del self._entries[key]
+
+        overflow = len(self._entries) - low_water
+        if overflow > 0:
+            for key in list(itertools.islice(self._entries, overflow)):
+                del self._entries[key]
+
+        self.stats["evictions"] += len(expired) + max(overflow, 0)
+
+    def invalidate(self, user_id, channel):
+        if self._entries.pop(self._key(user_id, channel), None) is not None:
+            self.stats["invalidations"] += 1
+
+    def invalidate_user(self, user_id, negative_only=False):
+        keys = [
+            key for key, entry in self._entries.items()
+            if key[0] == user_id and not (negative_only and entry[0])
+        ]
+        for key in keys:
+            del self._entries[key]
+        self.stats["invalidations"] += len(keys)
+
+    def invalidate_channel(self, channel):
+        key_channel = channel_key(channel)
+        keys = [key for key in self._entries if key[1] == key_channel]
+        for key in keys:
+            del self._entries[key]
+        self.stats["invalidations"] += len(keys)
+
+    def size(self):
+        return len(self._entries)
+
+
+subscription_cache = SubscriptionCache(
+    SUBSCRIPTION_CACHE_POSITIVE_TTL,
+    SUBSCRIPTION_CACHE_NEGATIVE_TTL,
+    SUBSCRIPTION_CACHE_MAX_ENTRIES,
+)
+
+
+subscription_state_stats = {
+    "local_hits": 0,
+    "api_checks": 0,
+    "api_errors": 0,
+    "events": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+}
+
+# Shared by every handler, so concurrent updates together never have more
+# than SUBSCRIPTION_CHECK_CONCURRENCY get_chat_member calls in flight.
+subscription_check_semaphore = asyncio.Semaphore(SUBSCRIPTION_CHECK_CONCURRENCY)
+
+
+def channel_key(channel) -> str:
+    return normalize_channel_username(str(channel)).lower()
+
+
+def _load_subscription_states(cur, user_ids, channel_keys, any_age=False):
+    if any_age:
+        cur.execute(
+            """
+            SELECT user_id, channel_id, is_member
+            FROM channel_subscriptions
+            WHERE user_id = ANY(%s)
+              AND channel_id = ANY(%s)
+            """,
+            (list(user_ids), list(channel_keys)),
+        )
+        return {(user_id, channel): bool(is_member) for user_id, channel, is_member in cur.fetchall()}
+
+    now = datetime.now(timezone.utc)
+    cur.execute(
+        """
+        SELECT user_id, channel_id, is_member
+        FROM channel_subscriptions
+        WHERE user_id = ANY(%s)
+          AND channel_id = ANY(%s)
+          AND updated_at > CASE WHEN is_member THEN %s ELSE %s END
+        """,
+        (
+            list(user_ids),
+            list(channel_keys),
+            now - timedelta(seconds=SUBSCRIPTION_STATE_MAX_AGE),
+            now - timedelta(seconds=SUBSCRIPTION_STATE_NEGATIVE_MAX_AGE),
+        ),
+    )
+    return {(user_id, channel): bool(is_member) for user_id, channel, is_member in cur.fetchall()}
+
+
+def _store_subscription_states(cur, rows):
+    # rows: (user_id, channel_key, is_member, observed_at, unsubscribed_at).
+    # Older observations never overwrite newer ones, so out-of-order
+    # chat_member updates and slow API fallbacks cannot flip the state back.
+    latest = {}
+    for row in rows:
+        latest[(row[0], row[1])] = row
+    rows = list(latest.values())
+
+    execute_values(
+        cur,
+        """
+        INSERT INTO channel_subscriptions (user_id, channel_id, is_member, subscribed_at, unsubscribed_at, updated_at)
+        VALUES %s
+        ON CONFLICT (user_id, channel_id) DO UPDATE
+        SET is_member = EXCLUDED.is_member,
+            subscribed_at = CASE
+                WHEN EXCLUDED.is_member AND NOT channel_subscriptions.is_member THEN EXCLUDED.updated_at
+                ELSE COALESCE(channel_subscriptions.subscribed_at, EXCLUDED.subscribed_at)
+            END,
+            unsubscribed_at = CASE
+                WHEN EXCLUDED.is_member THEN NULL
+                WHEN channel_subscriptions.is_member THEN COALESCE(EXCLUDED.unsubscribed_at, EXCLUDED.updated_at)
+                ELSE channel_subscriptions.unsubscribed_at
+            END,
+            updated_at = EXCLUDED.updated_at
+        WHERE channel_subscriptions.updated_at IS NULL
+           OR channel_subscriptions.updated_at <= EXCLUDED.updated_at
+        """,
+        [
+            (user_id, channel, is_member, observed_at if is_member else None, unsubscribed_at, observed_at)
+            for user_id, channel, is_member, observed_at, unsubscribed_at in rows
+        ],
+        template="(%s, %s, %s, %s::timestamptz, %s::timestamptz, %s::timestamptz)",
+        page_size=max(len(rows), 1),
+    )
+
+
+# Errors that say something about the user, not about the bot's access to
+# the channel.
+USER_LEVEL_CHAT_MEMBER_ERRORS = ("user not found", "participant_id_invalid", "user_id_invalid")
+
+
+class ChannelCircuitBreaker:
+    # Per-channel breaker for get_chat_member. After `threshold` consecutive
+    # channel-level errors (bot removed, channel renamed, no rights) the
+    # channel is skipped; one probe call is let through every probe_interval
+    # seconds and a successful probe closes it again.
+
+    def __init__(self, threshold, probe_interval):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self._channels = {}
+        self.stats = {"opened": 0, "closed": 0, "skipped": 0, "probes": 0}
+
+    def _state(self, channel):
+        return self._channels.setdefault(
+            channel_key(channel),
+            {"failures": 0, "open": False, "next_probe_at": 0.0, "probing": False, "last_error": None},
+        )
+
+    def allow(self, channel):
+        state = self._state(channel)
+        if not state["open"]:
+            return True
+
+        if not state["probing"] and time.monotonic() >= state["next_probe_at"]:
+            state["probing"] = True
+            self.stats["probes"] += 1
+            return True
+
+        self.stats["skipped"] += 1
+        return False
+
+    def record_success(self, channel):
+        # Returns True when this closes an open circuit.
+        state = self._state(channel)
+        was_open = state["open"]
+        state.update({"failures": 0, "open": False, "probing": False, "last_error": None})
+        if was_open:
+            self.stats["closed"] += 1
+        return was_open
+
+    def record_failure(self, channel, error):
+        # Returns True when this failure opens the circuit.
+        state = self._state(channel)
+        state["failures"] += 1
+        state["last_error"] = str(error)
+        state["probing"] = False
+
+        if state["open"]:
+            state["next_probe_at"] = time.monotonic() + self.probe_interval
+            return False
+
+        if state["failures"] >= self.threshold:
+            state["open"] = True
+            state["next_probe_at"] = time.monotonic() + self.probe_interval
+            self.stats["opened"] += 1
+            return True
+        return False
+
+    def is_open(self, channel):
+        return self._state(channel)["open"]
+
+    def release_probe(self, channel):
+        # The probe ended with an error that says nothing about the channel.
+        self._state(channel)["probing"] = False
+
+    def open_channels(self):
+        return {
+            channel: state["last_error"]
+            for channel, state in self._channels.items()
+            if state["open"]
+        }
+
+
+channel_breaker = ChannelCircuitBreaker(CHANNEL_BREAKER_FAILURES, CHANNEL_BREAKER_PROBE_SECONDS)
+
+
+def is_channel_level_error(error) -> bool:
+    if not isinstance(error, (BadRequest, Forbidden)):
+        return False
+    message = str(error).lower()
+    return not any(marker in message for marker in USER_LEVEL_CHAT_MEMBER_ERRORS)
+
+
+async def fetch_subscription(user_id, channel, context):
+    async with subscription_check_semaphore:
+        stats = subscription_state_stats
+        stats["api_checks"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
+            error = None
+        except Exception as e:
+            stats["api_errors"] += 1
+            member = None
+            error = e
+        finally:
+            stats["in_flight"] -= 1
+
+    if error is None:
+        if channel_breaker.record_success(channel):
+            await notify_admins(
+                context,
+                f"✅ <b>Проверка подписки на {html.escape(channel)} снова работает</b>",
+            )
+        return member.status in SUBSCRIBED_STATUSES
+
+    if not is_channel_level_error(error):
+        if isinstance(error, BadRequest):
+            channel_breaker.record_success(channel)
+        else:
+            channel_breaker.release_probe(channel)
+        return None
+
+    if channel_breaker.record_failure(channel, error):
+        await notify_admins(
+            context,
+            (
+                f"⚠️ <b>Не удаётся проверить подписку на {html.escape(channel)}</b>\n\n"
+                f"Ошибка: {html.escape(str(error))}\n"
+                f"Проверки по каналу приостановлены, повтор раз в "
+                f"{int(CHANNEL_BREAKER_PROBE_SECONDS)} с. Пока канал недоступен, используются "
+                f"последние известные данные. Проверьте, что бот — администратор канала "
+                f"и что username не изменился."
+            ),
+        )
+    return None
+
+
+class SingleFlight:
+    # Concurrent callers asking for the same key share one in-flight task,
+    # so repeated taps on "🔄 Обновить статус" cost one get_chat_member per
+    # (user, channel) instead of one per tap. The task is shielded: a caller
+    # that gets cancelled does not cancel it for the others.
+
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, factory):
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _, key=key: self._inflight.pop(key, None))
+        else:
+            self.stats["shared"] += 1
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._inflight)
+
+
+chat_member_flight = SingleFlight()
+
+
+async def check_subscriptions(user_ids, channels, context, verify=False):
+    # Membership for every (user_id, channel) pair: in-process cache first,
+    # then channel_subscriptions (kept current by chat_member updates), and
+    # get_chat_member only for pairs the bot knows nothing recent about.
+    # verify=True skips both and asks get_chat_member for every pair.
+    results = {}
+    misses = []
+    for user_id in user_ids:
+        for channel in channels:
+            cached = None if verify else subscription_cache.get(user_id, channel)
+            if cached is None:
+                misses.append((user_id, channel))
+            else:
+                results[(user_id, channel)] = cached
+
+    if not misses:
+        return results
+
+    local = {} if verify else await run_db(
+        _load_subscription_states,
+        {user_id for user_id, _ in misses},
+        {channel_key(channel) for _, channel in misses},
+    )
+
+    unknown = []
+    blocked = []
+    for user_id, channel in misses:
+        is_member = local.get((user_id, channel_key(channel)))
+        if is_member is None:
+            if channel_breaker.allow(channel):
+                unknown.append((user_id, channel))
+            else:
+                blocked.append((user_id, channel))
+            continue
+
+        subscription_state_stats["local_hits"] += 1
+        subscription_cache.set(user_id, channel, is_member)
+        results[(user_id, channel)] = is_member
+
+    # All network checks finish before anything is written, and no DB
+    # connection is checked out while they are in flight.
+    answers = await asyncio.gather(
+        *(
+            chat_member_flight.do(
+                (user_id, channel_key(channel)),
+                functools.partial(fetch_subscription, user_id, channel, context),
+            )
+            for user_id, channel in unknown
+        )
+    )
+
+    if blocked:
+        # The channel's circuit is open: fall back to whatever was last known.
+        last_known = await run_db(
+            _load_subscription_states,
+            {user_id for user_id, _ in blocked},
+            {channel_key(channel) for _, channel in blocked},
+            any_age=True,
+        )
+        for user_id, channel in blocked:
+            results[(user_id, channel)] = last_known.get((user_id, channel_key(channel)), False)
+
+    fetched = []
+    observed_at = datetime.now(timezone.utc)
+    for (user_id, channel), is_member in zip(unknown, answers):
+        if is_member is None:
+            results[(user_id, channel)] = False
+            continue
+
+        subscription_cache.set(user_id, channel, is_member)
+        results[(user_id, channel)] = is_member
+        fetched.append((user_id, channel_key(channel), is_member, observed_at, None))
+
+    if fetched:
         try:
-            await context.bot.send_message(admin_id, text, parse_mode=ParseMode.HTML)
+            await run_db(_store_subscription_states, fetched)
         except Exception as e:
-            print("notify_admins error:", e)
+            print("store subscription states error:", e)
+
+    return results
 
 
 async def check_subscription(user_id, channel, context):
+    results = await check_subscriptions([user_id], [channel], context)
+    return results[(user_id, channel)]
+
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    if not member_update or not member_update.chat.username:
+        return
+
+    was_member = member_update.old_chat_member.status in SUBSCRIBED_STATUSES
+    is_member = member_update.new_chat_member.status in SUBSCRIBED_STATUSES
+    if was_member == is_member:
+        return
+
+    subscription_state_stats["events"] += 1
+    user_id = member_update.new_chat_member.user.id
+    channel = channel_key(member_update.chat.username)
+    observed_at = member_update.date or datetime.now(timezone.utc)
+
+    subscription_cache.set(user_id, channel, is_member)
+
+    def _apply(cur):
+        _store_subscription_states(
+            cur,
+            [(user_id, channel, is_member, observed_at, None if is_member else observed_at)],
+        )
+        # Referral validity depends on sponsor membership; put this user's
+        # referrals at the front of referral_revalidation_job's walk.
+        cur.execute("UPDATE referrals SET checked_at = NULL WHERE referred_id = %s", (user_id,))
+
     try:
-        member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
-    except Exception:
-        return False
+        await run_db(_apply)
+    except Exception as e:
+        print("chat_member_update error:", e)
+
+
+async def bot_blocked_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Telegram reports blocking / unblocking the bot in a private chat as a
+    # my_chat_member update, so most blocks are recorded before any send fails.
+    member_update = update.my_chat_member
+    if not member_update or member_update.chat.type != "private":
+        return
+
+    user_id = member_update.chat.id
+    status = member_update.new_chat_member.status
+    try:
+        if status == "kicked":
+            reachability.mark_unreachable(user_id, to_naive_utc(member_update.date))
+        elif status == "member":
+            await mark_user_reachable(user_id)
+    except Exception as e:
+        print("bot_blocked_update error:", e)
 
 
 def get_level_info(ref_count: int):
@@ -330,202 +1112,55 @@ def get_welcome_inline(user_id: int):
 def init_db():
     try:
         with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id BIGINT PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        referrer_id BIGINT NULL,
-                        activated BOOLEAN DEFAULT FALSE,
-                        all_subscribed INT DEFAULT 0,
-                        tickets INT DEFAULT 0,
-                        last_fortune_time TIMESTAMP NULL,
-                        lifetime_ref_count INT DEFAULT 0,
-                        weekly_hold_bonus_count INT DEFAULT 0,
-                        last_hold_bonus_at TIMESTAMP NULL,
-                        last_level_notified TEXT DEFAULT 'Bronze',
-                        last_seen TIMESTAMP NULL,
-                        created_at TIMESTAMP DEFAULT NOW(),
-                        welcome_spin_used BOOLEAN DEFAULT FALSE
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS referrals (
-                        referrer_id BIGINT,
-                        referred_id BIGINT,
-                        is_valid BOOLEAN DEFAULT FALSE,
-                        checked_at TIMESTAMP NULL,
-                        inactive_since TIMESTAMP NULL,
-                        UNIQUE(referrer_id, referred_id)
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS channel_subscriptions (
-                        user_id BIGINT,
-                        channel_id TEXT,
-                        subscribed_at TIMESTAMPTZ DEFAULT NOW(),
-                        PRIMARY KEY (user_id, channel_id)
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS fortune_spins (
-                        spin_id TEXT PRIMARY KEY,
-                        user_id BIGINT,
-                        prize_code TEXT,
-                        created_at TIMESTAMP
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS exchange_requests (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT,
-                        username TEXT,
-                        exchange_type TEXT,
-                        stars_amount INT,
-                        status TEXT DEFAULT 'new',
-                        created_at TIMESTAMP DEFAULT NOW()
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS sponsor_slots (
-                        slot_no INT PRIMARY KEY,
-                        sponsor_type TEXT NOT NULL,
-                        channel_username TEXT,
-                        order_id INT NULL,
-                        is_active BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT NOW()
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS sponsor_orders (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT,
-                        username TEXT,
-                        channel_username TEXT,
-                        target_subscribers INT DEFAULT 100,
-                        counted_subscribers INT DEFAULT 0,
-                        active_subscribers INT DEFAULT 0,
-                        priority_level INT DEFAULT 0,
-                        stars_amount INT NOT NULL,
-                        status TEXT DEFAULT 'waiting_link',
-                        placed_in_slot BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT NOW(),
-                        completed_at TIMESTAMP NULL
-                    )
-                    """
-                )
-
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS sponsor_order_members (
-                        order_id INT NOT NULL,
-                        user_id BIGINT NOT NULL,
-                        counted_at TIMESTAMP DEFAULT NOW(),
-                        still_subscribed BOOLEAN DEFAULT TRUE,
-                        PRIMARY KEY (order_id, user_id)
+            current_version = get_schema_version(conn)
+            target_version = latest_migration_version()
+
+            if current_version < target_version:
+                if not DB_AUTO_MIGRATE:
+                    print(
+                        f"⚠️ Схема БД устарела ({current_version} < {target_version}). "
+                        f"Запустите: python migrate.py up"
                     )
-                    """
-                )
-
-                alter_statements = [
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS activated BOOLEAN DEFAULT FALSE",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS all_subscribed INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS tickets INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_fortune_time TIMESTAMP NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS active_ref_count INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS activation_bonus_percent INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS boost_percent INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS boost_spins_left INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS activation_reward_paid BOOLEAN DEFAULT FALSE",
-                    "ALTER TABLE referrals ADD COLUMN IF NOT EXISTS inactive_since TIMESTAMP NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active_at TIMESTAMP NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS lifetime_ref_count INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS weekly_hold_bonus_count INT DEFAULT 0",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_hold_bonus_at TIMESTAMP NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_level_notified TEXT DEFAULT 'Bronze'",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW()",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT NULL",
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS welcome_spin_used BOOLEAN DEFAULT FALSE",
-                ]
-
-                for stmt in alter_statements:
-                    try:
-                        cursor.execute(stmt)
-                    except Exception as e:
-                        print("ALTER warning:", e)
-
-                try:
-                    cursor.execute("ALTER TABLE users DROP COLUMN IF EXISTS profile_badge")
-                except Exception as e:
-                    print("DROP COLUMN warning:", e)
-
-                cursor.execute(
-                    """
-                    INSERT INTO sponsor_slots (slot_no, sponsor_type, is_active)
-                    VALUES
-                        (1, 'main', FALSE),
-                        (2, 'main', FALSE),
-                        (3, 'temp', FALSE)
-                    ON CONFLICT (slot_no) DO NOTHING
-                    """
-                )
+                    return
 
-                conn.commit()
+                applied = apply_migrations(conn)
+                print(f"✅ Применено миграций: {len(applied)}")
 
         print("✅ База данных подключена и инициализирована.")
     except Exception as e:
         print(f"❌ Ошибка БД: {e}")
 
 
-def get_active_sponsors_sync(include_temp=True):
-    sponsors = []
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            if include_temp:
-                cur.execute(
-                    """
-                    SELECT slot_no, sponsor_type, channel_username
-                    FROM sponsor_slots
-                    WHERE is_active = TRUE AND channel_username IS NOT NULL
-                    ORDER BY slot_no
-                    """
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT slot_no, sponsor_type, channel_username
-                    FROM sponsor_slots
-                    WHERE is_active = TRUE
-                      AND sponsor_type = 'main'
-                      AND channel_username IS NOT NULL
-                    ORDER BY slot_no
-                    """
-                )
-            rows = cur.fetchall()
+prepared_statements.register(
+    "active_sponsors_all",
+    """
+    SELECT slot_no, sponsor_type, channel_username
+    FROM sponsor_slots
+    WHERE is_active = TRUE AND channel_username IS NOT NULL
+    ORDER BY slot_no
+    """,
+)
+prepared_statements.register(
+    "active_sponsors_main",
+    """
+    SELECT slot_no, sponsor_type, channel_username
+    FROM sponsor_slots
+    WHERE is_active = TRUE
+      AND sponsor_type = 'main'
+      AND channel_username IS NOT NULL
+    ORDER BY slot_no
+    """,
+)
+
+
+def get_active_sponsors_sync(cur, include_temp=True):
+    if include_temp:
+        prepared_statements.execute(cur, "active_sponsors_all")
+    else:
+        prepared_statements.execute(cur, "active_sponsors_main")
+    rows = cur.fetchall()
 
+    sponsors = []
     for slot_no, sponsor_type, channel_username in rows:
         sponsors.append(
             {
@@ -538,356 +1173,576 @@ def get_active_sponsors_sync(include_temp=True):
 
 
 async def get_active_sponsors(include_temp=True):
-    return get_active_sponsors_sync(include_temp=include_temp)
+    return await run_db(get_active_sponsors_sync, include_temp=include_temp)
 
 
-async def recount_temp_order_progress(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT order_id, channel_username
-                    FROM sponsor_slots
-                    WHERE slot_no = 3
-                      AND is_active = TRUE
-                      AND order_id IS NOT NULL
-                      AND channel_username IS NOT NULL
-                    """
-                )
-                row = cur.fetchone()
-                if not row:
-                    return
+def _save_order_members(cur, order_id, results):
+    # results: (user_id, is_subscribed) pairs for one sponsor order.
+    now = utcnow()
+    subscribed = [(order_id, user_id, now) for user_id, is_sub in results if is_sub]
+    unsubscribed = [(order_id, user_id) for user_id, is_sub in results if not is_sub]
+
+    if subscribed:
+        execute_values(
+            cur,
+            """
+            INSERT INTO sponsor_order_members (order_id, user_id, counted_at, still_subscribed)
+            VALUES %s
+            ON CONFLICT (order_id, user_id)
+            DO UPDATE SET still_subscribed = TRUE
+            """,
+            subscribed,
+            template="(%s, %s, %s, TRUE)",
+            page_size=len(subscribed),
+        )
 
-                order_id, channel_username = row
-
-                cur.execute("SELECT user_id FROM users")
-                users = [r[0] for r in cur.fetchall()]
-
-                for user_id in users:
-                    is_sub = await check_subscription(user_id, channel_username, context)
-                    if is_sub:
-                        cur.execute(
-                            """
-                            INSERT INTO sponsor_order_members (order_id, user_id, counted_at, still_subscribed)
-                            VALUES (%s, %s, %s, TRUE)
-                            ON CONFLICT (order_id, user_id)
-                            DO UPDATE SET still_subscribed = TRUE
-                            """,
-                            (order_id, user_id, utcnow()),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE sponsor_order_members
-                            SET still_subscribed = FALSE
-                            WHERE order_id = %s AND user_id = %s
-                            """,
-                            (order_id, user_id),
-                        )
+    if unsubscribed:
+        execute_values(
+            cur,
+            """
+            UPDATE sponsor_order_members AS m
+            SET still_subscribed = FALSE
+            FROM (VALUES %s) AS v(order_id, user_id)
+            WHERE m.order_id = v.order_id
+              AND m.user_id = v.user_id
+              AND m.still_subscribed = TRUE
+            """,
+            unsubscribed,
+            template="(%s::int, %s::bigint)",
+            page_size=len(unsubscribed),
+        )
 
-                cur.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM sponsor_order_members
-                    WHERE order_id = %s
-                    """,
-                    (order_id,),
-                )
-                counted_total = int(cur.fetchone()[0] or 0)
 
-                cur.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM sponsor_order_members
-                    WHERE order_id = %s AND still_subscribed = TRUE
-                    """,
-                    (order_id,),
+async def recount_temp_order_progress(context: ContextTypes.DEFAULT_TYPE):
+    # One chunk of the slot-3 order recount per call. The position is kept in
+    # sponsor_order_recount, so a restart continues where it stopped. Only
+    # users seen since the order was placed, users already counted for it and
+    # users with a recent membership change in its channel are candidates.
+    def _load_chunk(cur):
+        cur.execute(
+            """
+            SELECT s.order_id, s.channel_username, COALESCE(o.placed_at, o.created_at, TIMESTAMP 'epoch')
+            FROM sponsor_slots s
+            JOIN sponsor_orders o ON o.id = s.order_id
+            WHERE s.slot_no = 3
+              AND s.is_active = TRUE
+              AND s.order_id IS NOT NULL
+              AND s.channel_username IS NOT NULL
+            """
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        order_id, channel_username, since = row
+
+        cur.execute(
+            """
+            INSERT INTO sponsor_order_recount (order_id, pass_started_at)
+            VALUES (%s, %s)
+            ON CONFLICT (order_id) DO NOTHING
+            """,
+            (order_id, utcnow()),
+        )
+        cur.execute("SELECT last_user_id FROM sponsor_order_recount WHERE order_id = %s", (order_id,))
+        last_user_id = int(cur.fetchone()[0] or 0)
+
+        cur.execute(
+            """
+            SELECT u.user_id
+            FROM users u
+            WHERE u.user_id > %s
+              AND (
+                (u.is_reachable = TRUE AND (u.last_active_at >= %s OR u.last_seen >= %s))
+                OR EXISTS (
+                    SELECT 1 FROM sponsor_order_members m
+                    WHERE m.order_id = %s AND m.user_id = u.user_id
                 )
-                active_total = int(cur.fetchone()[0] or 0)
-
-                cur.execute(
-                    """
-                    UPDATE sponsor_orders
-                    SET counted_subscribers = %s,
-                        active_subscribers = %s
-                    WHERE id = %s
-                    RETURNING target_subscribers, user_id, channel_username
-                    """,
-                    (counted_total, active_total, order_id),
+                OR EXISTS (
+                    SELECT 1 FROM channel_subscriptions cs
+                    WHERE cs.user_id = u.user_id AND cs.channel_id = %s AND cs.updated_at >= %s
                 )
-                order_row = cur.fetchone()
-                if not order_row:
-                    conn.commit()
-                    return
+              )
+            ORDER BY u.user_id
+            LIMIT %s
+            """,
+            (
+                last_user_id,
+                since,
+                since,
+                order_id,
+                channel_key(channel_username),
+                since.replace(tzinfo=timezone.utc),
+                ORDER_RECOUNT_CHUNK_SIZE,
+            ),
+        )
+        return order_id, channel_username, [r[0] for r in cur.fetchall()]
 
-                target_subscribers, order_user_id, order_channel = order_row
+    def _save_progress(cur, order_id, results, next_user_id):
+        now = utcnow()
+        _save_order_members(cur, order_id, results)
 
-                if counted_total >= int(target_subscribers):
-                    cur.execute(
-                        """
-                        UPDATE sponsor_orders
-                        SET status = 'completed',
-                            completed_at = %s
-                        WHERE id = %s
-                        """,
-                        (utcnow(), order_id),
-                    )
-                    cur.execute(
-                        """
-                        UPDATE sponsor_slots
-                        SET channel_username = NULL,
-                            order_id = NULL,
-                            is_active = FALSE
-                        WHERE slot_no = 3
-                        """
-                    )
-                    conn.commit()
-
-                    await notify_admins(
-                        context,
-                        (
-                            f"✅ <b>Временный спонсорский заказ выполнен</b>\n\n"
-                            f"Заказ #{order_id}\n"
-                            f"Канал: <b>{order_channel}</b>\n"
-                            f"Привлечено: <b>{counted_total}/{target_subscribers}</b>"
-                        ),
-                    )
+        if next_user_id is None:
+            cur.execute(
+                """
+                UPDATE sponsor_order_recount
+                SET last_user_id = 0,
+                    passes = passes + 1,
+                    pass_started_at = %s,
+                    updated_at = %s
+                WHERE order_id = %s
+                """,
+                (now, now, order_id),
+            )
+        else:
+            cur.execute(
+                """
+                UPDATE sponsor_order_recount
+                SET last_user_id = %s,
+                    updated_at = %s
+                WHERE order_id = %s
+                """,
+                (next_user_id, now, order_id),
+            )
 
-                    try:
-                        await context.bot.send_message(
-                            chat_id=order_user_id,
-                            text=(
-                                f"✅ <b>Ваш заказ выполнен</b>\n\n"
-                                f"Канал: <b>{order_channel}</b>\n"
-                                f"Привлечено: <b>{counted_total}/{target_subscribers}</b>"
-                            ),
-                            parse_mode=ParseMode.HTML,
-                        )
-                    except Exception as e:
-                        print("notify order user error:", e)
-
-                    await place_next_temp_order(context)
-                    return
+        cur.execute(
+            """
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE still_subscribed = TRUE)
+            FROM sponsor_order_members
+            WHERE order_id = %s
+            """,
+            (order_id,),
+        )
+        counted_total, active_total = cur.fetchone()
+        counted_total = int(counted_total or 0)
+        active_total = int(active_total or 0)
+
+        cur.execute(
+            """
+            UPDATE sponsor_orders
+            SET counted_subscribers = %s,
+                active_subscribers = %s
+            WHERE id = %s
+            RETURNING target_subscribers, user_id, channel_username
+            """,
+            (counted_total, active_total, order_id),
+        )
+        order_row = cur.fetchone()
+        if not order_row:
+            return None
+
+        target_subscribers, order_user_id, order_channel = order_row
+
+        if counted_total < int(target_subscribers):
+            return None
+
+        cur.execute(
+            """
+            UPDATE sponsor_orders
+            SET status = 'completed',
+                completed_at = %s
+            WHERE id = %s
+            """,
+            (utcnow(), order_id),
+        )
+        cur.execute(
+            """
+            UPDATE sponsor_slots
+            SET channel_username = NULL,
+                order_id = NULL,
+                is_active = FALSE
+            WHERE slot_no = 3
+            """
+        )
+        cur.execute("DELETE FROM sponsor_order_recount WHERE order_id = %s", (order_id,))
+
+        progress = f"Канал: <b>{order_channel}</b>\nПривлечено: <b>{counted_total}/{target_subscribers}</b>"
+        _enqueue_messages(
+            cur,
+            [
+                (admin_id, f"✅ <b>Временный спонсорский заказ выполнен</b>\n\nЗаказ #{order_id}\n{progress}")
+                for admin_id in ADMINS
+            ]
+            + [(order_user_id, f"✅ <b>Ваш заказ выполнен</b>\n\n{progress}")],
+            "order_completed",
+        )
+        return order_id
 
-                conn.commit()
+    try:
+        chunk = await run_db(_load_chunk)
+        if not chunk:
+            return
+
+        order_id, channel_username, users = chunk
+
+        memberships = await check_subscriptions(users, [channel_username], context)
+        results = [(user_id, memberships[(user_id, channel_username)]) for user_id in users]
+        next_user_id = users[-1] if len(users) >= ORDER_RECOUNT_CHUNK_SIZE else None
+
+        completed = await run_db(_save_progress, order_id, results, next_user_id)
+        if not completed:
+            return
+
+        await place_next_temp_order(context)
     except Exception as e:
         print("recount_temp_order_progress error:", e)
 
 
 async def place_next_temp_order(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT is_active FROM sponsor_slots WHERE slot_no = 3")
-                row = cur.fetchone()
-                if row and row[0]:
-                    return
-
-                cur.execute(
-                    """
-                    SELECT id, channel_username
-                    FROM sponsor_orders
-                    WHERE status = 'approved'
-                      AND placed_in_slot = FALSE
-                      AND channel_username IS NOT NULL
-                    ORDER BY priority_level DESC, created_at ASC
-                    LIMIT 1
-                    """
-                )
-                order = cur.fetchone()
-                if not order:
-                    return
+    def _place(cur):
+        cur.execute("SELECT is_active FROM sponsor_slots WHERE slot_no = 3")
+        row = cur.fetchone()
+        if row and row[0]:
+            return None
+
+        cur.execute(
+            """
+            SELECT id, channel_username
+            FROM sponsor_orders
+            WHERE status = 'approved'
+              AND placed_in_slot = FALSE
+              AND channel_username IS NOT NULL
+            ORDER BY priority_level DESC, created_at ASC
+            LIMIT 1
+            """
+        )
+        order = cur.fetchone()
+        if not order:
+            return None
+
+        order_id, channel_username = order
+
+        cur.execute(
+            """
+            UPDATE sponsor_slots
+            SET channel_username = %s,
+                order_id = %s,
+                is_active = TRUE
+            WHERE slot_no = 3
+            """,
+            (channel_username, order_id),
+        )
 
-                order_id, channel_username = order
+        cur.execute(
+            """
+            UPDATE sponsor_orders
+            SET placed_in_slot = TRUE,
+                status = 'active',
+                placed_at = %s
+            WHERE id = %s
+            """,
+            (utcnow(), order_id),
+        )
+        return order_id, channel_username
 
-                cur.execute(
-                    """
-                    UPDATE sponsor_slots
-                    SET channel_username = %s,
-                        order_id = %s,
-                        is_active = TRUE
-                    WHERE slot_no = 3
-                    """,
-                    (channel_username, order_id),
-                )
+    try:
+        placed = await run_db(_place)
+        if not placed:
+            return
 
-                cur.execute(
-                    """
-                    UPDATE sponsor_orders
-                    SET placed_in_slot = TRUE,
-                        status = 'active'
-                    WHERE id = %s
-                    """,
-                    (order_id,),
-                )
-                conn.commit()
+        order_id, channel_username = placed
+        subscription_cache.invalidate_channel(channel_username)
 
-                await notify_admins(
-                    context,
-                    (
-                        f"📢 <b>В слот 3 поставлен новый временный спонсор</b>\n\n"
-                        f"Заказ #{order_id}\n"
-                        f"Канал: <b>{channel_username}</b>"
-                    ),
-                )
+        await notify_admins(
+            context,
+            (
+                f"📢 <b>В слот 3 поставлен новый временный спонсор</b>\n\n"
+                f"Заказ #{order_id}\n"
+                f"Канал: <b>{channel_username}</b>"
+            ),
+        )
     except Exception as e:
         print("place_next_temp_order error:", e)
 
 
-async def count_valid_refs(referrer_id: int, context: ContextTypes.DEFAULT_TYPE) -> int:
-    now = datetime.now(timezone.utc).replace(tzinfo=None)
-    grace_period = timedelta(days=30)
-    active_count = 0
+def _load_stale_referrals(cur, cutoff, referrer_id=None, limit=None):
+    if referrer_id is not None:
+        cur.execute(
+            """
+            SELECT referrer_id, referred_id
+            FROM referrals
+            WHERE referrer_id = %s
+              AND (checked_at IS NULL OR checked_at < %s)
+            ORDER BY checked_at NULLS FIRST
+            LIMIT %s
+            """,
+            (referrer_id, cutoff, limit),
+        )
+    else:
+        cur.execute(
+            """
+            SELECT referrer_id, referred_id
+            FROM referrals
+            WHERE checked_at IS NULL OR checked_at < %s
+            ORDER BY checked_at NULLS FIRST
+            LIMIT %s
+            """,
+            (cutoff, limit),
+        )
+    return cur.fetchall()
+
+
+def _save_referral_checks(cur, checks):
+    # A referral that stops qualifying keeps counting for the grace period
+    # from the first failed check (inactive_since), as before.
+    execute_values(
+        cur,
+        """
+        UPDATE referrals AS r
+        SET is_valid = CASE WHEN v.valid_now THEN TRUE ELSE r.is_valid END,
+            inactive_since = CASE
+                WHEN v.valid_now THEN NULL
+                WHEN COALESCE(r.is_valid, FALSE) AND r.inactive_since IS NULL THEN v.checked_at
+                ELSE r.inactive_since
+            END,
+            checked_at = v.checked_at
+        FROM (VALUES %s) AS v(referrer_id, referred_id, valid_now, checked_at)
+        WHERE r.referrer_id = v.referrer_id
+          AND r.referred_id = v.referred_id
+        """,
+        checks,
+        template="(%s::bigint, %s::bigint, %s::boolean, %s::timestamp)",
+        page_size=len(checks),
+    )
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT referred_id, COALESCE(is_valid, FALSE), inactive_since FROM referrals WHERE referrer_id=%s",
-                (referrer_id,),
-            )
-            rows = cur.fetchall()
 
-            main_sponsors = await get_active_sponsors(include_temp=False)
+async def revalidate_referrals(pairs, context):
+    # pairs: (referrer_id, referred_id) rows to recheck against the main sponsors.
+    if not pairs:
+        return
 
-            for referred_id, was_valid, inactive_since in rows:
-                valid_now = True
+    now = utcnow()
+    main_sponsors = await get_active_sponsors(include_temp=False)
 
-                if len(main_sponsors) < 2:
-                    valid_now = False
-                else:
-                    for sponsor in main_sponsors:
-                        if not await check_subscription(referred_id, sponsor["channel_username"], context):
-                            valid_now = False
-                            break
+    memberships = {}
+    if len(main_sponsors) >= 2:
+        memberships = await check_subscriptions(
+            list({referred_id for _, referred_id in pairs}),
+            [sponsor["channel_username"] for sponsor in main_sponsors],
+            context,
+        )
 
-                if valid_now:
-                    cur.execute(
-                        """
-                        UPDATE referrals
-                        SET is_valid = TRUE,
-                            checked_at = %s,
-                            inactive_since = NULL
-                        WHERE referrer_id = %s AND referred_id = %s
-                        """,
-                        (now, referrer_id, referred_id),
-                    )
-                    active_count += 1
-                else:
-                    if was_valid:
-                        inactive_since_naive = to_naive_utc(inactive_since)
-
-                        if inactive_since_naive is None:
-                            cur.execute(
-                                """
-                                UPDATE referrals
-                                SET checked_at = %s,
-                                    inactive_since = %s
-                                WHERE referrer_id = %s AND referred_id = %s
-                                """,
-                                (now, now, referrer_id, referred_id),
-                            )
-                            active_count += 1
-                        elif (now - inactive_since_naive) < grace_period:
-                            cur.execute(
-                                """
-                                UPDATE referrals
-                                SET checked_at = %s
-                                WHERE referrer_id = %s AND referred_id = %s
-                                """,
-                                (now, referrer_id, referred_id),
-                            )
-                            active_count += 1
-                        else:
-                            cur.execute(
-                                """
-                                UPDATE referrals
-                                SET checked_at = %s
-                                WHERE referrer_id = %s AND referred_id = %s
-                                """,
-                                (now, referrer_id, referred_id),
-                            )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE referrals
-                            SET checked_at = %s
-                            WHERE referrer_id = %s AND referred_id = %s
-                            """,
-                            (now, referrer_id, referred_id),
-                        )
+    checks = []
+    for referrer_id, referred_id in pairs:
+        valid_now = len(main_sponsors) >= 2 and all(
+            memberships[(referred_id, sponsor["channel_username"])] for sponsor in main_sponsors
+        )
+        checks.append((referrer_id, referred_id, valid_now, now))
 
-            cur.execute(
-                "UPDATE users SET active_ref_count = %s WHERE user_id = %s",
-                (active_count, referrer_id),
+    await run_db(_save_referral_checks, checks)
+
+
+async def refresh_referrer(referrer_id: int, context: ContextTypes.DEFAULT_TYPE) -> int:
+    now = utcnow()
+    grace_period = timedelta(days=30)
+
+    def _save(cur):
+        cur.execute(
+            """
+            UPDATE users
+            SET active_ref_count = (
+                SELECT COUNT(*)
+                FROM referrals
+                WHERE referrer_id = %s
+                  AND COALESCE(is_valid, FALSE) = TRUE
+                  AND (inactive_since IS NULL OR inactive_since > %s)
             )
+            WHERE user_id = %s
+            RETURNING active_ref_count
+            """,
+            (referrer_id, now - grace_period, referrer_id),
+        )
+        row = cur.fetchone()
+        active_count = int(row[0]) if row else 0
 
-            activation_reward_granted = False
-            activation_reward_amount = 10
+        activation_reward_granted = False
+        activation_reward_amount = 10
 
-            if active_count >= 2:
-                cur.execute(
-                    """
-                    UPDATE users
-                    SET activated = TRUE,
-                        activation_bonus_percent = CASE
-                            WHEN COALESCE(activation_bonus_percent, 0) < 5 THEN 5
-                            ELSE activation_bonus_percent
-                        END,
-                        tickets = CASE
-                            WHEN COALESCE(activated, FALSE) = FALSE
-                             AND COALESCE(activation_reward_paid, FALSE) = FALSE
-                            THEN COALESCE(tickets, 0) + CASE
-                                WHEN created_at IS NOT NULL AND (%s - created_at) <= INTERVAL '3 days' THEN 20
-                                ELSE 10
-                            END
-                            ELSE COALESCE(tickets, 0)
-                        END,
-                        activation_reward_paid = CASE
-                            WHEN COALESCE(activated, FALSE) = FALSE
-                             AND COALESCE(activation_reward_paid, FALSE) = FALSE
-                            THEN TRUE
-                            ELSE COALESCE(activation_reward_paid, FALSE)
-                        END
-                    WHERE user_id = %s
-                    RETURNING
-                        CASE
-                            WHEN COALESCE(activated, FALSE) = FALSE
-                             AND COALESCE(activation_reward_paid, FALSE) = FALSE
-                            THEN TRUE
-                            ELSE FALSE
-                        END,
-                        CASE
+        if active_count >= 2:
+            cur.execute(
+                """
+                UPDATE users
+                SET activated = TRUE,
+                    activation_bonus_percent = CASE
+                        WHEN COALESCE(activation_bonus_percent, 0) < 5 THEN 5
+                        ELSE activation_bonus_percent
+                    END,
+                    tickets = CASE
+                        WHEN COALESCE(activated, FALSE) = FALSE
+                         AND COALESCE(activation_reward_paid, FALSE) = FALSE
+                        THEN COALESCE(tickets, 0) + CASE
                             WHEN created_at IS NOT NULL AND (%s - created_at) <= INTERVAL '3 days' THEN 20
                             ELSE 10
                         END
-                    """,
-                    (now, referrer_id, now),
-                )
-                activation_row = cur.fetchone()
-                if activation_row:
-                    activation_reward_granted = bool(activation_row[0])
-                    activation_reward_amount = int(activation_row[1])
-
-            conn.commit()
-
-    if active_count >= 2 and activation_reward_granted:
-        try:
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text=(
+                        ELSE COALESCE(tickets, 0)
+                    END,
+                    activation_reward_paid = CASE
+                        WHEN COALESCE(activated, FALSE) = FALSE
+                         AND COALESCE(activation_reward_paid, FALSE) = FALSE
+                        THEN TRUE
+                        ELSE COALESCE(activation_reward_paid, FALSE)
+                    END
+                WHERE user_id = %s
+                RETURNING
+                    CASE
+                        WHEN COALESCE(activated, FALSE) = FALSE
+                         AND COALESCE(activation_reward_paid, FALSE) = FALSE
+                        THEN TRUE
+                        ELSE FALSE
+                    END,
+                    CASE
+                        WHEN created_at IS NOT NULL AND (%s - created_at) <= INTERVAL '3 days' THEN 20
+                        ELSE 10
+                    END
+                """,
+                (now, referrer_id, now),
+            )
+            activation_row = cur.fetchone()
+            if activation_row:
+                activation_reward_granted = bool(activation_row[0])
+                activation_reward_amount = int(activation_row[1])
+
+        if active_count >= 2 and activation_reward_granted:
+            _enqueue_messages(
+                cur,
+                [(
+                    referrer_id,
                     "🎉 <b>Поздравляем!</b>\n\n"
                     f"Вы выполнили условие активации Звёздного Колеса и получили <b>+{activation_reward_amount}⭐</b>\n"
-                    "Теперь вам доступно бесплатное вращение каждые 6 часов."
-                ),
-                parse_mode=ParseMode.HTML,
+                    "Теперь вам доступно бесплатное вращение каждые 6 часов.",
+                )],
+                "activation_reward",
             )
-        except Exception as e:
-            print("activation reward notify error:", e)
 
+        return active_count
+
+    active_count = await run_db(_save)
+    invalidate_user_state(context, referrer_id)
     return active_count
 
+referral_recheck_queue = {}
+referral_job_stats = {
+    "runs": 0,
+    "priority": 0,
+    "checked": 0,
+    "referrers": 0,
+    "last_checked": 0,
+    "last_api_calls": 0,
+    "last_ms": 0.0,
+    "errors": 0,
+}
+
+
+def request_referral_recheck(referrer_id: int):
+    # Handlers only enqueue; referral_revalidation_job does the work at the
+    # next tick, ahead of the regular walk over stale referrals.
+    referral_recheck_queue[referrer_id] = True
+
+
+async def referral_revalidation_job(context: ContextTypes.DEFAULT_TYPE):
+    # Walks referrals in checked_at order until this tick's share of
+    # REFERRAL_RECHECK_BUDGET_PER_MINUTE get_chat_member calls is spent.
+    # Membership answered from channel_subscriptions costs nothing.
+    started = time.perf_counter()
+    budget = max(1, int(REFERRAL_RECHECK_BUDGET_PER_MINUTE * REFERRAL_RECHECK_INTERVAL_SECONDS / 60))
+    api_calls_before = subscription_state_stats["api_checks"]
+    checked = 0
+    refreshed = set()
+    dequeued = []
+
+    def _api_calls():
+        return subscription_state_stats["api_checks"] - api_calls_before
+
+    try:
+        cutoff = utcnow() - timedelta(seconds=REFERRAL_FRESHNESS_SECONDS)
+        priority_cutoff = utcnow() - timedelta(seconds=REFERRAL_PRIORITY_FRESHNESS_SECONDS)
+
+        while referral_recheck_queue and _api_calls() < budget:
+            referrer_id = next(iter(referral_recheck_queue))
+            del referral_recheck_queue[referrer_id]
+            dequeued.append(referrer_id)
+
+            limit = max(1, budget - _api_calls())
+            stale = await run_db(_load_stale_referrals, priority_cutoff, referrer_id=referrer_id, limit=limit)
+            await revalidate_referrals(stale, context)
+            checked += len(stale)
+            refreshed.add(referrer_id)
+            referral_job_stats["priority"] += 1
+            if len(stale) >= limit:
+                # More than this tick's budget: continue on the next tick.
+                referral_recheck_queue[referrer_id] = True
+
+        while _api_calls() < budget:
+            limit = min(REFERRAL_RECHECK_BATCH, max(1, budget - _api_calls()))
+            stale = await run_db(_load_stale_referrals, cutoff, limit=limit)
+            if not stale:
+                break
+
+            await revalidate_referrals(stale, context)
+            checked += len(stale)
+            refreshed.update(referrer_id for referrer_id, _ in stale)
+
+        for referrer_id in refreshed:
+            await refresh_referrer(referrer_id, context)
+            await notify_level_up_if_needed(referrer_id, context)
+    except Exception as e:
+        # Referrers taken off the queue this tick may not have been finished.
+        for referrer_id in dequeued:
+            referral_recheck_queue[referrer_id] = True
+        referral_job_stats["errors"] += 1
+        print("referral_revalidation_job error:", e)
+
+    referral_job_stats["runs"] += 1
+    referral_job_stats["checked"] += checked
+    referral_job_stats["referrers"] += len(refreshed)
+    referral_job_stats["last_checked"] = checked
+    referral_job_stats["last_api_calls"] = _api_calls()
+    referral_job_stats["last_ms"] = (time.perf_counter() - started) * 1000
+
+
+prepared_statements.register(
+    "user_set_all_subscribed",
+    "UPDATE users SET all_subscribed = %s WHERE user_id = %s",
+)
+prepared_statements.register(
+    "user_state",
+    """
+    SELECT
+        COALESCE(activated, FALSE),
+        COALESCE(active_ref_count, 0),
+        COALESCE(tickets, 0),
+        COALESCE(weekly_hold_bonus_count, 0),
+        last_fortune_time,
+        COALESCE(last_level_notified, 'Bronze'),
+        COALESCE(activation_bonus_percent, 0),
+        COALESCE(boost_percent, 0),
+        COALESCE(boost_spins_left, 0),
+        COALESCE(welcome_spin_used, FALSE)
+    FROM users
+    WHERE user_id = %s
+    """,
+)
+
+
+def get_update_state_cache(context) -> dict:
+    # CallbackContext is built once per update, so this memo lives exactly as
+    # long as the update that is being handled.
+    cache = getattr(context, "user_state_cache", None)
+    if cache is None:
+        cache = {}
+        context.user_state_cache = cache
+    return cache
+
+
+def invalidate_user_state(context, user_id: int):
+    get_update_state_cache(context).pop(user_id, None)
+
+
 async def get_user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    cache = get_update_state_cache(context)
+    if user_id in cache:
+        return cache[user_id]
+
     sponsors = await get_active_sponsors(include_temp=True)
 
     all_subs_ok = True
@@ -897,58 +1752,33 @@ async def get_user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE):
         channels_list = "Список спонсоров пока не настроен.\n"
         all_subs_ok = False
 
+    memberships = await check_subscriptions(
+        [user_id],
+        [sponsor["channel_username"] for sponsor in sponsors],
+        context,
+    )
+
     for sponsor in sponsors:
         ch = sponsor["channel_username"]
-        is_sub = await check_subscription(user_id, ch, context)
 
-        if is_sub:
+        if memberships[(user_id, ch)]:
             icon = "✅"
-            try:
-                with get_db_connection() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            """
-                            INSERT INTO channel_subscriptions (user_id, channel_id)
-                            VALUES (%s, %s)
-                            ON CONFLICT DO NOTHING
-                            """,
-                            (user_id, ch),
-                        )
-                        conn.commit()
-            except Exception as e:
-                print("channel_subscriptions save error:", e)
         else:
             icon = "❌"
             all_subs_ok = False
 
         channels_list += f"• {ch} {icon}\n"
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE users SET all_subscribed = %s WHERE user_id = %s",
-                (1 if all_subs_ok else 0, user_id),
-            )
-            cur.execute(
-                """
-                SELECT
-                    COALESCE(activated, FALSE),
-                    COALESCE(active_ref_count, 0),
-                    COALESCE(tickets, 0),
-                    COALESCE(weekly_hold_bonus_count, 0),
-                    last_fortune_time,
-                    COALESCE(last_level_notified, 'Bronze'),
-                    COALESCE(activation_bonus_percent, 0),
-                    COALESCE(boost_percent, 0),
-                    COALESCE(boost_spins_left, 0),
-                    COALESCE(welcome_spin_used, FALSE)
-                FROM users
-                WHERE user_id = %s
-                """,
-                (user_id,),
-            )
-            row = cur.fetchone()
-            conn.commit()
+    def _load(cur):
+        prepared_statements.execute(
+            cur,
+            "user_set_all_subscribed",
+            (1 if all_subs_ok else 0, user_id),
+        )
+        prepared_statements.execute(cur, "user_state", (user_id,))
+        return cur.fetchone()
+
+    row = await run_db(_load)
 
     activated = False
     ref_count = 0
@@ -982,7 +1812,7 @@ async def get_user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE):
         + int(boost_percent or 0)
     )
 
-    return {
+    state = {
         "activated": activated,
         "all_subs_ok": all_subs_ok,
         "channels_list": channels_list,
@@ -998,6 +1828,8 @@ async def get_user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE):
         "welcome_spin_used": bool(welcome_spin_used),
         "total_bonus_percent": total_bonus_percent,
     }
+    cache[user_id] = state
+    return state
 
 
 async def notify_level_up_if_needed(user_id: int, context: ContextTypes.DEFAULT_TYPE):
@@ -1005,143 +1837,303 @@ async def notify_level_up_if_needed(user_id: int, context: ContextTypes.DEFAULT_
         state = await get_user_state(user_id, context)
         current_level = state["level"]["name"]
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT COALESCE(last_level_notified, 'Bronze') FROM users WHERE user_id = %s",
-                    (user_id,),
-                )
-                row = cur.fetchone()
-                prev_level = row[0] if row else "Bronze"
+        def _mark_notified(cur):
+            cur.execute(
+                "SELECT COALESCE(last_level_notified, 'Bronze') FROM users WHERE user_id = %s",
+                (user_id,),
+            )
+            row = cur.fetchone()
+            prev_level = row[0] if row else "Bronze"
 
-                if prev_level != current_level:
-                    cur.execute(
-                        "UPDATE users SET last_level_notified = %s WHERE user_id = %s",
-                        (current_level, user_id),
-                    )
-                    conn.commit()
-
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=(
-                            f"🎉 <b>Поздравляем!</b>\n\n"
-                            f"Ваш уровень повышен до <b>{state['level']['emoji']} {current_level}</b>\n"
-                            f"🌠 <b>Бонус к Звёздному Колесу:</b> +{state['total_bonus_percent']}%\n"
-                            f"📌 <b>Этот бонус повышает шанс выпадения звёздных секторов</b>"
-                        ),
-                        parse_mode=ParseMode.HTML,
-                    )
+            if prev_level == current_level:
+                return
+
+            cur.execute(
+                "UPDATE users SET last_level_notified = %s WHERE user_id = %s",
+                (current_level, user_id),
+            )
+            _enqueue_messages(
+                cur,
+                [(
+                    user_id,
+                    f"🎉 <b>Поздравляем!</b>\n\n"
+                    f"Ваш уровень повышен до <b>{state['level']['emoji']} {current_level}</b>\n"
+                    f"🌠 <b>Бонус к Звёздному Колесу:</b> +{state['total_bonus_percent']}%\n"
+                    f"📌 <b>Этот бонус повышает шанс выпадения звёздных секторов</b>",
+                )],
+                "level_up",
+            )
+
+        await run_db(_mark_notified)
     except Exception as e:
         print("notify_level_up_if_needed error:", e)
 
 
-async def apply_inactivity_decay(user_id: int, context):
-    now = utcnow()
+class HeartbeatBuffer:
+    # last_seen / last_active_at only need to be accurate to about a minute,
+    # so they are collected here and written in one batched UPDATE.
 
-    def _apply():
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT COALESCE(tickets, 0), last_active_at
-                    FROM users
-                    WHERE user_id = %s
-                """, (user_id,))
-                row = cur.fetchone()
-
-                if not row:
-                    return {"decayed": 0, "new_balance": None}
-
-                tickets, last_active_at = row
-                tickets = int(tickets or 0)
-
-                if last_active_at is None:
-                    cur.execute("""
-                        UPDATE users
-                        SET last_active_at = %s
-                        WHERE user_id = %s
-                    """, (now, user_id))
-                    conn.commit()
-                    return {"decayed": 0, "new_balance": tickets}
-
-                inactive_days = (now - last_active_at).days
-                decayed = 0
-                new_balance = tickets
-
-                if inactive_days > 10 and tickets > 150:
-                    penalty_days = inactive_days - 7
-                    penalty = penalty_days * 2
-                    new_balance = max(150, tickets - penalty)
-                    decayed = tickets - new_balance
-
-                    cur.execute("""
-                        UPDATE users
-                        SET tickets = %s,
-                            last_active_at = %s
-                        WHERE user_id = %s
-                    """, (new_balance, now, user_id))
-                else:
-                    cur.execute("""
-                        UPDATE users
-                        SET last_active_at = %s
-                        WHERE user_id = %s
-                    """, (now, user_id))
+    def __init__(self):
+        self._pending = {}
+        self.stats = {
+            "flushes": 0,
+            "rows": 0,
+            "errors": 0,
+            "last_size": 0,
+            "last_ms": 0.0,
+            "max_ms": 0.0,
+        }
 
-                conn.commit()
-                return {"decayed": decayed, "new_balance": new_balance}
+    def _entry(self, user_id: int):
+        return self._pending.setdefault(
+            user_id,
+            {"last_seen": None, "last_active_at": None, "profile": None},
+        )
 
-    return await asyncio.to_thread(_apply)
+    def touch_seen(self, user_id: int, username, first_name, ts):
+        entry = self._entry(user_id)
+        entry["last_seen"] = ts
+        entry["profile"] = (username, first_name)
 
+    def touch_active(self, user_id: int, ts):
+        self._entry(user_id)["last_active_at"] = ts
 
-async def process_weekly_hold_bonus(user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    main_sponsors = await get_active_sponsors(include_temp=False)
+    def has_pending_activity(self, user_id: int) -> bool:
+        entry = self._pending.get(user_id)
+        return bool(entry and entry["last_active_at"])
 
-    if len(main_sponsors) < 2:
-        return False, "Основные спонсоры не настроены"
+    def pending_count(self) -> int:
+        return len(self._pending)
 
-    for sponsor in main_sponsors:
-        if not await check_subscription(user_id, sponsor["channel_username"], context):
-            return False, "Нет подписки на одного из основных спонсоров"
+    def drain(self):
+        pending, self._pending = self._pending, {}
+        return pending
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    COALESCE(weekly_hold_bonus_count, 0),
-                    last_hold_bonus_at
-                FROM users
-                WHERE user_id = %s
-                """,
-                (user_id,),
+    def restore(self, pending):
+        for user_id, entry in pending.items():
+            current = self._entry(user_id)
+            for key in ("last_seen", "last_active_at"):
+                if entry[key] and (current[key] is None or entry[key] > current[key]):
+                    current[key] = entry[key]
+            if current["profile"] is None:
+                current["profile"] = entry["profile"]
+
+
+heartbeat_buffer = HeartbeatBuffer()
+
+
+def _write_heartbeats(cur, pending):
+    rows = []
+    for user_id, entry in pending.items():
+        profile = entry["profile"]
+        rows.append(
+            (
+                user_id,
+                entry["last_seen"],
+                entry["last_active_at"],
+                profile is not None,
+                profile[0] if profile else None,
+                profile[1] if profile else None,
             )
-            row = cur.fetchone()
+        )
 
-            if not row:
-                return False, "Пользователь не найден"
+    execute_values(
+        cur,
+        """
+        UPDATE users AS u
+        SET last_seen = GREATEST(u.last_seen, v.last_seen),
+            last_active_at = GREATEST(u.last_active_at, v.last_active_at),
+            username = CASE WHEN v.has_profile THEN v.username ELSE u.username END,
+            first_name = CASE WHEN v.has_profile THEN v.first_name ELSE u.first_name END
+        FROM (VALUES %s) AS v(user_id, last_seen, last_active_at, has_profile, username, first_name)
+        WHERE u.user_id = v.user_id
+        """,
+        rows,
+        template="(%s::bigint, %s::timestamp, %s::timestamp, %s::boolean, %s::text, %s::text)",
+        page_size=max(len(rows), 1),
+    )
 
-            weekly_count = int(row[0] or 0)
-            last_hold_bonus_at = to_naive_utc(row[1])
 
-            if weekly_count >= MAX_WEEKLY_HOLD_BONUSES:
-                return False, "Достигнут максимум недельных бонусов"
+async def flush_heartbeats(context=None):
+    pending = heartbeat_buffer.drain()
+    if not pending:
+        return
+
+    started = time.perf_counter()
+    try:
+        await run_db(_write_heartbeats, pending)
+    except Exception as e:
+        heartbeat_buffer.restore(pending)
+        heartbeat_buffer.stats["errors"] += 1
+        print("flush_heartbeats error:", e)
+        return
 
-            now = utcnow()
-            if last_hold_bonus_at and (now - last_hold_bonus_at) < timedelta(days=7):
-                return False, "Бонус уже начислялся меньше недели назад"
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = heartbeat_buffer.stats
+    stats["flushes"] += 1
+    stats["rows"] += len(pending)
+    stats["last_size"] = len(pending)
+    stats["last_ms"] = elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+
+def _write_unreachable(cur, pending):
+    execute_values(
+        cur,
+        """
+        UPDATE users AS u
+        SET is_reachable = FALSE,
+            unreachable_at = v.unreachable_at
+        FROM (VALUES %s) AS v(user_id, unreachable_at)
+        WHERE u.user_id = v.user_id
+          AND u.is_reachable = TRUE
+        """,
+        list(pending.items()),
+        template="(%s::bigint, %s::timestamp)",
+        page_size=max(len(pending), 1),
+    )
 
-            cur.execute(
-                """
+
+async def flush_reachability(context=None):
+    pending = reachability.drain()
+    if not pending:
+        return
+
+    try:
+        await run_db(_write_unreachable, pending)
+        reachability.stats["written"] += len(pending)
+    except Exception as e:
+        reachability.restore(pending)
+        reachability.stats["errors"] += 1
+        print("flush_reachability error:", e)
+
+
+async def mark_user_reachable(user_id: int):
+    reachability.forget(user_id)
+
+    def _clear(cur):
+        cur.execute(
+            """
+            UPDATE users
+            SET is_reachable = TRUE, unreachable_at = NULL
+            WHERE user_id = %s AND is_reachable = FALSE
+            RETURNING user_id
+            """,
+            (user_id,),
+        )
+        return cur.fetchone() is not None
+
+    if await run_db(_clear):
+        reachability.stats["cleared"] += 1
+
+
+async def apply_inactivity_decay(user_id: int, context):
+    now = utcnow()
+
+    if heartbeat_buffer.has_pending_activity(user_id):
+        heartbeat_buffer.touch_active(user_id, now)
+        return {"decayed": 0, "new_balance": None}
+
+    def _apply(cur):
+        cur.execute("""
+            SELECT COALESCE(tickets, 0), last_active_at
+            FROM users
+            WHERE user_id = %s
+        """, (user_id,))
+        row = cur.fetchone()
+
+        if not row:
+            return {"decayed": 0, "new_balance": None}
+
+        tickets, last_active_at = row
+        tickets = int(tickets or 0)
+
+        if last_active_at is None:
+            return {"decayed": 0, "new_balance": tickets}
+
+        inactive_days = (now - last_active_at).days
+        decayed = 0
+        new_balance = tickets
+
+        if inactive_days > 10 and tickets > 150:
+            penalty_days = inactive_days - 7
+            penalty = penalty_days * 2
+            new_balance = max(150, tickets - penalty)
+            decayed = tickets - new_balance
+
+            cur.execute("""
                 UPDATE users
-                SET tickets = tickets + %s,
-                    weekly_hold_bonus_count = weekly_hold_bonus_count + 1,
-                    last_hold_bonus_at = %s
+                SET tickets = %s,
+                    last_active_at = %s
                 WHERE user_id = %s
-                """,
-                (WEEKLY_HOLD_BONUS, now, user_id),
-            )
-            conn.commit()
+            """, (new_balance, now, user_id))
+
+        return {"decayed": decayed, "new_balance": new_balance}
+
+    result = await run_db(_apply)
+    if result["decayed"] > 0:
+        invalidate_user_state(context, user_id)
+    elif result["new_balance"] is not None:
+        heartbeat_buffer.touch_active(user_id, now)
+    return result
+
 
-    return True, f"Начислено {WEEKLY_HOLD_BONUS} ⭐"
+async def process_weekly_hold_bonus(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    main_sponsors = await get_active_sponsors(include_temp=False)
+
+    if len(main_sponsors) < 2:
+        return False, "Основные спонсоры не настроены"
+
+    memberships = await check_subscriptions(
+        [user_id],
+        [sponsor["channel_username"] for sponsor in main_sponsors],
+        context,
+    )
+    if not all(memberships.values()):
+        return False, "Нет подписки на одного из основных спонсоров"
+
+    def _grant(cur):
+        cur.execute(
+            """
+            SELECT
+                COALESCE(weekly_hold_bonus_count, 0),
+                last_hold_bonus_at
+            FROM users
+            WHERE user_id = %s
+            """,
+            (user_id,),
+        )
+        row = cur.fetchone()
+
+        if not row:
+            return False, "Пользователь не найден"
+
+        weekly_count = int(row[0] or 0)
+        last_hold_bonus_at = to_naive_utc(row[1])
+
+        if weekly_count >= MAX_WEEKLY_HOLD_BONUSES:
+            return False, "Достигнут максимум недельных бонусов"
+
+        now = utcnow()
+        if last_hold_bonus_at and (now - last_hold_bonus_at) < timedelta(days=7):
+            return False, "Бонус уже начислялся меньше недели назад"
+
+        cur.execute(
+            """
+            UPDATE users
+            SET tickets = tickets + %s,
+                weekly_hold_bonus_count = weekly_hold_bonus_count + 1,
+                last_hold_bonus_at = %s
+            WHERE user_id = %s
+            """,
+            (WEEKLY_HOLD_BONUS, now, user_id),
+        )
+        return True, f"Начислено {WEEKLY_HOLD_BONUS} ⭐"
+
+    granted, message = await run_db(_grant)
+    if granted:
+        invalidate_user_state(context, user_id)
+    return granted, message
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1164,48 +2156,47 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             referrer_id = None
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-            exists = cur.fetchone()
+    def _upsert_user(cur):
+        cur.execute(
+            """
+            INSERT INTO users (user_id, username, first_name, referrer_id, tickets, last_seen)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET is_reachable = TRUE, unreachable_at = NULL
+            WHERE users.is_reachable = FALSE
+            RETURNING (xmax = 0)
+            """,
+            (user_id, username, first_name, referrer_id, START_BONUS, utcnow()),
+        )
+        # No row: existing reachable user. xmax <> 0: an unreachable user
+        # came back and the flag was cleared by the update above.
+        row = cur.fetchone()
+        created = bool(row and row[0])
+        if row and not row[0]:
+            reachability.stats["cleared"] += 1
+
+        if created and referrer_id:
+            cur.execute(
+                """
+                INSERT INTO referrals (referrer_id, referred_id, is_valid, checked_at)
+                VALUES (%s, %s, FALSE, NULL)
+                ON CONFLICT (referrer_id, referred_id) DO NOTHING
+                """,
+                (referrer_id, user_id),
+            )
 
-            if not exists:
-                cur.execute(
-                    """
-                    INSERT INTO users (user_id, username, first_name, referrer_id, tickets, last_seen)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    """,
-                    (user_id, username, first_name, referrer_id, START_BONUS, utcnow()),
-                )
+        return created
 
-                if referrer_id:
-                    cur.execute(
-                        """
-                        INSERT INTO referrals (referrer_id, referred_id, is_valid, checked_at)
-                        VALUES (%s, %s, FALSE, NULL)
-                        ON CONFLICT (referrer_id, referred_id) DO NOTHING
-                        """,
-                        (referrer_id, user_id),
-                    )
-            else:
-                cur.execute(
-                    """
-                    UPDATE users
-                    SET username = %s,
-                        first_name = %s,
-                        last_seen = %s
-                    WHERE user_id = %s
-                    """,
-                    (username, first_name, utcnow(), user_id),
-                )
+    created = await run_db(_upsert_user)
+    if created:
+        invalidate_user_state(context, user_id)
+    else:
+        heartbeat_buffer.touch_seen(user_id, username, first_name, utcnow())
+        reachability.forget(user_id)
 
-            conn.commit()
-
-    await count_valid_refs(user_id, context)
-
-    if referrer_id:
-        await count_valid_refs(referrer_id, context)
-        await notify_level_up_if_needed(referrer_id, context)
+    request_referral_recheck(user_id)
+    if referrer_id and created:
+        request_referral_recheck(referrer_id)
 
     state = await get_user_state(user_id, context)
 
@@ -1265,9 +2256,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 pass
 
+            if data == "check_sub":
+                subscription_cache.invalidate_user(uid, negative_only=True)
+                request_referral_recheck(uid)
+
             decay_result = await apply_inactivity_decay(uid, context)
-            await count_valid_refs(uid, context)
-            await recount_temp_order_progress(context)
 
             state = await get_user_state(uid, context)
 
@@ -1379,22 +2372,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
-                        (PREMIUM_COST, uid),
-                    )
-                    new_balance = int(cur.fetchone()[0])
+            def _create_premium(cur):
+                cur.execute(
+                    "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
+                    (PREMIUM_COST, uid),
+                )
+                new_balance = int(cur.fetchone()[0])
 
-                    cur.execute(
-                        """
-                        INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
-                        VALUES (%s, %s, %s, %s)
-                        """,
-                        (uid, query.from_user.username, "premium_3m", PREMIUM_COST),
-                    )
-                    conn.commit()
+                cur.execute(
+                    """
+                    INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (uid, query.from_user.username, "premium_3m", PREMIUM_COST),
+                )
+                return new_balance
+
+            new_balance = await run_db(_create_premium)
+            invalidate_user_state(context, uid)
 
             await notify_admins(
                 context,
@@ -1438,22 +2433,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
-                        (WITHDRAW_MIN, uid),
-                    )
-                    new_balance = int(cur.fetchone()[0])
+            def _create_withdraw(cur):
+                cur.execute(
+                    "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
+                    (WITHDRAW_MIN, uid),
+                )
+                new_balance = int(cur.fetchone()[0])
 
-                    cur.execute(
-                        """
-                        INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
-                        VALUES (%s, %s, %s, %s)
-                        """,
-                        (uid, query.from_user.username, "withdraw", WITHDRAW_MIN),
-                    )
-                    conn.commit()
+                cur.execute(
+                    """
+                    INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (uid, query.from_user.username, "withdraw", WITHDRAW_MIN),
+                )
+                return new_balance
+
+            new_balance = await run_db(_create_withdraw)
+            invalidate_user_state(context, uid)
 
             await notify_admins(
                 context,
@@ -1521,30 +2518,32 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET
-                            tickets = tickets - %s,
-                            boost_percent = %s,
-                            boost_spins_left = %s
-                        WHERE user_id = %s
-                        RETURNING tickets
-                        """,
-                        (boost_cost, boost_percent, boost_spins, uid),
-                    )
-                    new_balance = int(cur.fetchone()[0])
+            def _buy_boost(cur):
+                cur.execute(
+                    """
+                    UPDATE users
+                    SET
+                        tickets = tickets - %s,
+                        boost_percent = %s,
+                        boost_spins_left = %s
+                    WHERE user_id = %s
+                    RETURNING tickets
+                    """,
+                    (boost_cost, boost_percent, boost_spins, uid),
+                )
+                new_balance = int(cur.fetchone()[0])
 
-                    cur.execute(
-                        """
-                        INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
-                        VALUES (%s, %s, %s, %s)
-                        """,
-                        (uid, query.from_user.username, exchange_type, boost_cost),
-                    )
-                    conn.commit()
+                cur.execute(
+                    """
+                    INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (uid, query.from_user.username, exchange_type, boost_cost),
+                )
+                return new_balance
+
+            new_balance = await run_db(_buy_boost)
+            invalidate_user_state(context, uid)
 
             await query.edit_message_text(
                 (
@@ -1575,40 +2574,42 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
-                        (stars_cost, uid),
-                    )
-                    new_balance = int(cur.fetchone()[0])
+            def _create_order(cur):
+                cur.execute(
+                    "UPDATE users SET tickets = tickets - %s WHERE user_id = %s RETURNING tickets",
+                    (stars_cost, uid),
+                )
+                new_balance = int(cur.fetchone()[0])
 
-                    cur.execute(
-                        """
-                        INSERT INTO sponsor_orders (
-                            user_id, username, target_subscribers, counted_subscribers,
-                            active_subscribers, priority_level, stars_amount, status, placed_in_slot
-                        )
-                        VALUES (%s, %s, %s, 0, 0, %s, %s, 'waiting_link', FALSE)
-                        RETURNING id
-                        """,
-                        (uid, query.from_user.username, 100, priority_level, stars_cost),
+                cur.execute(
+                    """
+                    INSERT INTO sponsor_orders (
+                        user_id, username, target_subscribers, counted_subscribers,
+                        active_subscribers, priority_level, stars_amount, status, placed_in_slot
                     )
-                    order_id = int(cur.fetchone()[0])
+                    VALUES (%s, %s, %s, 0, 0, %s, %s, 'waiting_link', FALSE)
+                    RETURNING id
+                    """,
+                    (uid, query.from_user.username, 100, priority_level, stars_cost),
+                )
+                order_id = int(cur.fetchone()[0])
 
-                    cur.execute(
-                        """
-                        INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
-                        VALUES (%s, %s, %s, %s)
-                        """,
-                        (
-                            uid,
-                            query.from_user.username,
-                            "sponsor_channel_priority" if priority_level == 1 else "sponsor_channel",
-                            stars_cost,
-                        ),
-                    )
-                    conn.commit()
+                cur.execute(
+                    """
+                    INSERT INTO exchange_requests (user_id, username, exchange_type, stars_amount)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (
+                        uid,
+                        query.from_user.username,
+                        "sponsor_channel_priority" if priority_level == 1 else "sponsor_channel",
+                        stars_cost,
+                    ),
+                )
+                return new_balance, order_id
+
+            new_balance, order_id = await run_db(_create_order)
+            invalidate_user_state(context, uid)
 
             context.user_data["waiting_sponsor_order_id"] = order_id
 
@@ -1674,18 +2675,18 @@ async def text_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    UPDATE sponsor_orders
-                    SET channel_username = %s,
-                        status = 'approved'
-                    WHERE id = %s AND user_id = %s
-                    """,
-                    (channel_username, waiting_order_id, uid),
-                )
-                conn.commit()
+        def _save_channel(cur):
+            cur.execute(
+                """
+                UPDATE sponsor_orders
+                SET channel_username = %s,
+                    status = 'approved'
+                WHERE id = %s AND user_id = %s
+                """,
+                (channel_username, waiting_order_id, uid),
+            )
+
+        await run_db(_save_channel)
 
         context.user_data.pop("waiting_sponsor_order_id", None)
         await place_next_temp_order(context)
@@ -1786,139 +2787,1099 @@ async def text_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if text == "🏆 Лидерборд":
-        try:
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        SELECT first_name, username, COALESCE(tickets, 0) AS stars
-                        FROM users
-                        ORDER BY stars DESC, user_id ASC
-                        LIMIT 10
-                        """
-                    )
-                    rows = cur.fetchall()
+    if text == "🏆 Лидерборд":
+        try:
+            def _load_leaderboard(cur):
+                cur.execute(
+                    """
+                    SELECT first_name, username, COALESCE(tickets, 0) AS stars
+                    FROM users
+                    ORDER BY stars DESC, user_id ASC
+                    LIMIT 10
+                    """
+                )
+                return cur.fetchall()
+
+            rows = await run_db(_load_leaderboard, replica=True)
+
+            if not rows:
+                await update.message.reply_text("Лидерборд пока пуст.")
+                return
+
+            msg = "🏆 <b>Лидерборд</b>\n"
+            for i, (first_name, username, stars) in enumerate(rows, 1):
+                name = first_name or display_username(username)
+                msg += f"{i}. <b>{name}</b> — {stars}⭐\n"
+
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+            ])
+            await update.message.reply_text(
+                msg,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+            )
+        except Exception as e:
+            await update.message.reply_text(f"Ошибка: {e}")
+        return
+
+    if text.startswith("🌠 Звёздное Колесо"):
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+        ])
+        await update.message.reply_text(
+            "Откройте WebApp кнопкой в меню ниже 👇",
+            reply_markup=keyboard,
+        )
+        return
+
+    await update.message.reply_text("Используйте кнопки меню.")
+
+
+async def sponsor_slots_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    try:
+        def _load_slots(cur):
+            cur.execute(
+                """
+                SELECT
+                    s.slot_no,
+                    s.sponsor_type,
+                    s.channel_username,
+                    s.order_id,
+                    s.is_active,
+                    o.target_subscribers,
+                    o.counted_subscribers,
+                    o.active_subscribers
+                FROM sponsor_slots s
+                LEFT JOIN sponsor_orders o ON o.id = s.order_id
+                ORDER BY s.slot_no
+                """
+            )
+            return cur.fetchall()
+
+        rows = await run_db(_load_slots)
+
+        text = "📢 <b>Слоты спонсоров</b>\n\n"
+        for row in rows:
+            slot_no, sponsor_type, channel_username, order_id, is_active, target, counted, active = row
+
+            if not is_active or not channel_username:
+                text += f"Слот {slot_no}: пусто\n\n"
+                continue
+
+            if sponsor_type == "main":
+                text += f"Слот {slot_no} (основной): {channel_username}\n\n"
+            else:
+                text += (
+                    f"Слот {slot_no} (временный): {channel_username}\n"
+                    f"Заказ #{order_id}\n"
+                    f"Привлечено: {counted or 0}/{target or 0}\n"
+                    f"Удержано: {active or 0}\n\n"
+                )
+
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+async def sponsor_queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    try:
+        def _load_queue(cur):
+            cur.execute(
+                """
+                SELECT id, username, channel_username, priority_level, stars_amount, status, created_at
+                FROM sponsor_orders
+                WHERE status IN ('waiting_link', 'approved', 'active')
+                ORDER BY
+                    CASE
+                        WHEN status = 'active' THEN 0
+                        WHEN status = 'approved' THEN 1
+                        ELSE 2
+                    END,
+                    priority_level DESC,
+                    created_at ASC
+                """
+            )
+            return cur.fetchall()
+
+        rows = await run_db(_load_queue)
+
+        if not rows:
+            await update.message.reply_text("Очередь пуста.")
+            return
+
+        text = "🗂 <b>Очередь / активные заказы</b>\n\n"
+        for row in rows:
+            order_id, username, channel_username, priority_level, stars_amount, status, created_at = row
+            text += (
+                f"#{order_id} | {display_username(username)}\n"
+                f"Канал: {channel_username or 'не указан'}\n"
+                f"Статус: {status}\n"
+                f"Приоритет: {'высокий' if priority_level == 1 else 'обычный'}\n"
+                f"Оплачено: {stars_amount}⭐\n\n"
+            )
+
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+async def set_main_sponsor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    if len(context.args) < 2:
+        await update.message.reply_text("Использование: /set_main_sponsor <1|2> <@channel>")
+        return
+
+    try:
+        slot_no = int(context.args[0])
+        channel_username = normalize_channel_username(context.args[1])
+
+        if slot_no not in (1, 2):
+            await update.message.reply_text("Можно указать только слот 1 или 2.")
+            return
+
+        member = await context.bot.get_chat_member(channel_username, context.bot.id)
+        if member.status not in ["administrator", "creator"]:
+            await update.message.reply_text("Бот не является администратором этого канала.")
+            return
+
+        def _set_slot(cur):
+            cur.execute(
+                """
+                UPDATE sponsor_slots
+                SET channel_username = %s,
+                    is_active = TRUE,
+                    order_id = NULL
+                WHERE slot_no = %s
+                """,
+                (channel_username, slot_no),
+            )
+
+        await run_db(_set_slot)
+        subscription_cache.invalidate_channel(channel_username)
+
+        await update.message.reply_text(
+            f"✅ Основной спонсор для слота {slot_no} установлен: {channel_username}"
+        )
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+async def remove_temp_sponsor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    try:
+        def _clear_slot(cur):
+            cur.execute("SELECT order_id FROM sponsor_slots WHERE slot_no = 3")
+            row = cur.fetchone()
+            order_id = row[0] if row else None
+
+            if order_id:
+                cur.execute(
+                    """
+                    UPDATE sponsor_orders
+                    SET status = 'completed',
+                        completed_at = %s
+                    WHERE id = %s
+                    """,
+                    (utcnow(), order_id),
+                )
+
+            cur.execute(
+                """
+                UPDATE sponsor_slots
+                SET channel_username = NULL,
+                    order_id = NULL,
+                    is_active = FALSE
+                WHERE slot_no = 3
+                """
+            )
+
+        await run_db(_clear_slot)
+
+        await update.message.reply_text("✅ Временный спонсор удалён из слота 3.")
+        await place_next_temp_order(context)
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+async def check_sponsor_progress_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    await recount_temp_order_progress(context)
+
+    def _load_progress(cur):
+        cur.execute(
+            """
+            SELECT o.id, o.channel_username, o.counted_subscribers, o.active_subscribers,
+                   o.target_subscribers, r.last_user_id, r.passes, r.pass_started_at
+            FROM sponsor_slots s
+            JOIN sponsor_orders o ON o.id = s.order_id
+            LEFT JOIN sponsor_order_recount r ON r.order_id = o.id
+            WHERE s.slot_no = 3 AND s.is_active = TRUE
+            """
+        )
+        return cur.fetchone()
+
+    row = await run_db(_load_progress)
+    if not row:
+        await update.message.reply_text("✅ Прогресс временного спонсора обновлён. Слот 3 свободен.")
+        return
+
+    order_id, channel, counted, active, target, last_user_id, passes, pass_started_at = row
+    await update.message.reply_text(
+        f"✅ Прогресс временного спонсора обновлён.\n\n"
+        f"Заказ #{order_id} ({channel})\n"
+        f"Засчитано: {counted}/{target}, подписаны сейчас: {active}\n"
+        f"Проход №{(passes or 0) + 1}, позиция: user_id > {last_user_id or 0}"
+        + (f", начат {pass_started_at:%d.%m %H:%M} UTC" if pass_started_at else "")
+    )
+
+
+async def run_sponsor_audit_chunk(audit_id: int, channel: str, context: ContextTypes.DEFAULT_TYPE):
+    def _load_chunk(cur):
+        cur.execute(
+            "SELECT last_user_id FROM sponsor_audits WHERE id = %s AND status = 'running'",
+            (audit_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        cur.execute(
+            """
+            SELECT user_id FROM users
+            WHERE user_id > %s AND is_reachable = TRUE
+            ORDER BY user_id
+            LIMIT %s
+            """,
+            (row[0], SPONSOR_AUDIT_CHUNK_SIZE),
+        )
+        return [r[0] for r in cur.fetchall()]
+
+    users = await run_db(_load_chunk)
+    if users is None:
+        return
+
+    # An audit must not trust cached positives, which live for days.
+    memberships = await check_subscriptions(users, [channel], context, verify=True)
+
+    if channel_breaker.is_open(channel):
+        def _pause(cur):
+            cur.execute(
+                """
+                UPDATE sponsor_audits
+                SET status = 'paused',
+                    error = 'канал недоступен для проверки',
+                    updated_at = %s
+                WHERE id = %s AND status = 'running'
+                """,
+                (utcnow(), audit_id),
+            )
+
+        await run_db(_pause)
+        return
+
+    results = [(user_id, memberships[(user_id, channel)]) for user_id in users]
+    finished = len(users) < SPONSOR_AUDIT_CHUNK_SIZE
+
+    def _save(cur):
+        # Membership itself is already in channel_subscriptions; if the channel
+        # is the live slot-3 order, the order's member list is updated too.
+        cur.execute(
+            """
+            SELECT order_id
+            FROM sponsor_slots
+            WHERE slot_no = 3
+              AND is_active = TRUE
+              AND order_id IS NOT NULL
+              AND lower(channel_username) = %s
+            """,
+            (channel_key(channel),),
+        )
+        order_row = cur.fetchone()
+        if order_row and results:
+            _save_order_members(cur, order_row[0], results)
+
+        now = utcnow()
+        cur.execute(
+            """
+            UPDATE sponsor_audits
+            SET last_user_id = %s,
+                processed = processed + %s,
+                members = members + %s,
+                status = CASE WHEN %s THEN 'done' ELSE status END,
+                finished_at = CASE WHEN %s THEN %s ELSE finished_at END,
+                updated_at = %s
+            WHERE id = %s AND status = 'running'
+            RETURNING started_by, processed, members
+            """,
+            (
+                users[-1] if users else 0,
+                len(users),
+                sum(1 for _, is_sub in results if is_sub),
+                finished,
+                finished,
+                now,
+                now,
+                audit_id,
+            ),
+        )
+        return cur.fetchone()
+
+    row = await run_db(_save)
+    if not row or not finished:
+        return
+
+    started_by, processed, members = row
+    if started_by:
+        await enqueue_message(
+            started_by,
+            (
+                f"✅ <b>Аудит #{audit_id} завершён</b>\n\n"
+                f"Канал: {html.escape(channel)}\n"
+                f"Проверено пользователей: {processed}\n"
+                f"Подписаны: {members}"
+            ),
+            "sponsor_audit",
+        )
+
+
+async def sponsor_audit_job(context: ContextTypes.DEFAULT_TYPE):
+    def _load_running(cur):
+        cur.execute("SELECT id, channel_id FROM sponsor_audits WHERE status = 'running' ORDER BY id")
+        return cur.fetchall()
+
+    try:
+        for audit_id, channel in await run_db(_load_running):
+            await run_sponsor_audit_chunk(audit_id, channel, context)
+    except Exception as e:
+        print("sponsor_audit_job error:", e)
+
+
+def format_sponsor_audit(row) -> str:
+    (
+        audit_id, channel, status, total_users, processed, members,
+        resumed_at, processed_at_resume, error, created_at,
+    ) = row
+
+    status_names = {
+        "running": "⏳ выполняется",
+        "paused": "⏸ приостановлен",
+        "cancelled": "⛔️ отменён",
+        "done": "✅ завершён",
+    }
+    percent = min(100.0, processed / total_users * 100) if total_users else 100.0
+    text = (
+        f"#{audit_id} {html.escape(channel)} — {status_names.get(status, status)}\n"
+        f"Проверено: {processed}/{total_users} ({percent:.1f}%), подписаны: {members}\n"
+    )
+
+    if status == "running" and resumed_at:
+        elapsed = max((utcnow() - resumed_at).total_seconds(), 1.0)
+        rate = (processed - processed_at_resume) / elapsed
+        text += f"Скорость: {rate * 60:.0f} польз./мин"
+        if rate > 0 and total_users > processed:
+            text += f", осталось ~{int((total_users - processed) / rate / 60) + 1} мин"
+        text += "\n"
+
+    if error:
+        text += f"Причина остановки: {html.escape(error)}\n"
+    return text
+
+
+async def audit_sponsor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    usage = (
+        "Использование:\n"
+        "/audit_sponsor start @channel\n"
+        "/audit_sponsor status [id]\n"
+        "/audit_sponsor cancel <id>\n"
+        "/audit_sponsor resume <id>"
+    )
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+
+    action = context.args[0].lower()
+    audit_columns = """
+        id, channel_id, status, total_users, processed, members,
+        resumed_at, processed_at_resume, error, created_at
+    """
+
+    try:
+        if action == "start" and len(context.args) >= 2:
+            channel = channel_key(context.args[1])
+
+            def _start(cur):
+                cur.execute(
+                    "SELECT id FROM sponsor_audits WHERE channel_id = %s AND status IN ('running', 'paused')",
+                    (channel,),
+                )
+                existing = cur.fetchone()
+                if existing:
+                    return existing[0], False
+
+                cur.execute("SELECT COUNT(*) FROM users WHERE is_reachable = TRUE")
+                total_users = int(cur.fetchone()[0] or 0)
+                cur.execute(
+                    """
+                    INSERT INTO sponsor_audits (channel_id, started_by, total_users, resumed_at)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING id
+                    """,
+                    (channel, update.effective_user.id, total_users, utcnow()),
+                )
+                return cur.fetchone()[0], True
+
+            audit_id, created = await run_db(_start)
+            if created:
+                await update.message.reply_text(
+                    f"⏳ Аудит #{audit_id} канала {channel} запущен. "
+                    f"Прогресс: /audit_sponsor status {audit_id}"
+                )
+            else:
+                await update.message.reply_text(
+                    f"Для {channel} уже есть аудит #{audit_id}. "
+                    f"Продолжить: /audit_sponsor resume {audit_id}"
+                )
+            return
+
+        if action == "status":
+            audit_id = int(context.args[1]) if len(context.args) >= 2 else None
+
+            def _status(cur):
+                if audit_id is not None:
+                    cur.execute(f"SELECT {audit_columns} FROM sponsor_audits WHERE id = %s", (audit_id,))
+                else:
+                    cur.execute(f"SELECT {audit_columns} FROM sponsor_audits ORDER BY id DESC LIMIT 5")
+                return cur.fetchall()
+
+            rows = await run_db(_status)
+            if not rows:
+                await update.message.reply_text("Аудитов нет.")
+                return
+
+            text = "🔎 <b>Аудит аудитории спонсоров</b>\n\n" + "\n".join(format_sponsor_audit(row) for row in rows)
+            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+            return
+
+        if action in ("cancel", "resume") and len(context.args) >= 2:
+            audit_id = int(context.args[1])
+
+            def _change(cur):
+                now = utcnow()
+                if action == "cancel":
+                    cur.execute(
+                        """
+                        UPDATE sponsor_audits
+                        SET status = 'cancelled', updated_at = %s, finished_at = %s
+                        WHERE id = %s AND status IN ('running', 'paused')
+                        RETURNING id
+                        """,
+                        (now, now, audit_id),
+                    )
+                else:
+                    cur.execute(
+                        """
+                        UPDATE sponsor_audits
+                        SET status = 'running',
+                            error = NULL,
+                            resumed_at = %s,
+                            processed_at_resume = processed,
+                            finished_at = NULL,
+                            updated_at = %s
+                        WHERE id = %s AND status IN ('paused', 'cancelled')
+                        RETURNING id
+                        """,
+                        (now, now, audit_id),
+                    )
+                return cur.fetchone() is not None
+
+            if not await run_db(_change):
+                await update.message.reply_text(f"Аудит #{audit_id} нельзя {'отменить' if action == 'cancel' else 'продолжить'}.")
+                return
+
+            if action == "cancel":
+                await update.message.reply_text(f"⛔️ Аудит #{audit_id} отменён. Продолжить: /audit_sponsor resume {audit_id}")
+            else:
+                await update.message.reply_text(f"▶️ Аудит #{audit_id} продолжен с последней отметки.")
+            return
+
+        await update.message.reply_text(usage)
+    except psycopg2.IntegrityError:
+        await update.message.reply_text("Для этого канала уже есть активный аудит.")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+BROADCAST_LEVEL_REFS = {
+    "bronze": (0, 4),
+    "silver": (4, 8),
+    "gold": (8, 12),
+    "diamond": (12, None),
+}
+BROADCAST_FILTER_RE = re.compile(r"^(activated|level|seen|subscribed|balance)=(\S+)(?:\s+|$)")
+
+BROADCAST_USAGE = (
+    "Использование: /broadcast [фильтры] текст\n\n"
+    "Фильтры (можно сочетать):\n"
+    "activated=1|0 — активировал Колесо\n"
+    "level=bronze|silver|gold|diamond — уровень\n"
+    "seen=N — заходил за последние N дней\n"
+    "subscribed=1|0 — подписан на всех спонсоров\n"
+    "balance=N — баланс от N⭐\n\n"
+    "Пример: /broadcast activated=1 seen=14 Новый розыгрыш!"
+)
+
+
+def parse_broadcast_args(raw: str):
+    filters = {}
+    rest = raw.lstrip()
+    while True:
+        match = BROADCAST_FILTER_RE.match(rest)
+        if not match:
+            break
+        filters[match.group(1)] = match.group(2).lower()
+        rest = rest[match.end():]
+    return filters, rest
+
+
+def build_segment_where(filters: dict):
+    # seen, activated=1, level and balance can use an index (migrations
+    # 0003, 0010). activated=0 and subscribed match most users and are only
+    # applied as filters; on their own they scan the whole table.
+    clauses = ["is_reachable = TRUE"]
+    params = []
+
+    if "activated" in filters:
+        if filters["activated"] not in ("1", "0"):
+            raise ValueError("activated: ожидается 1 или 0")
+        clauses.append("activated = TRUE" if filters["activated"] == "1" else "activated IS NOT TRUE")
+
+    if "level" in filters:
+        if filters["level"] not in BROADCAST_LEVEL_REFS:
+            raise ValueError("level: bronze, silver, gold или diamond")
+        low, high = BROADCAST_LEVEL_REFS[filters["level"]]
+        clauses.append("COALESCE(active_ref_count, 0) >= %s")
+        params.append(low)
+        if high is not None:
+            clauses.append("COALESCE(active_ref_count, 0) < %s")
+            params.append(high)
+
+    if "seen" in filters:
+        days = int(filters["seen"])
+        if days <= 0:
+            raise ValueError("seen: число дней больше 0")
+        clauses.append("last_seen >= %s")
+        params.append(utcnow() - timedelta(days=days))
+
+    if "subscribed" in filters:
+        if filters["subscribed"] not in ("1", "0"):
+            raise ValueError("subscribed: ожидается 1 или 0")
+        clauses.append("COALESCE(all_subscribed, 0) = 1" if filters["subscribed"] == "1" else "COALESCE(all_subscribed, 0) <> 1")
+
+    if "balance" in filters:
+        clauses.append("COALESCE(tickets, 0) >= %s")
+        params.append(int(filters["balance"]))
+
+    return " AND ".join(clauses), params
+
+
+def describe_segment(filters: dict) -> str:
+    if not filters:
+        return "все пользователи"
+    return " ".join(f"{key}={value}" for key, value in sorted(filters.items()))
+
+
+def estimate_send_minutes(recipients: int) -> int:
+    rate = min(BROADCAST_RATE, TELEGRAM_GLOBAL_RATE)
+    return int(recipients / rate / 60) + 1 if rate > 0 else 0
+
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+
+    if not context.args:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+
+    filters, msg = parse_broadcast_args(update.message.text.split(" ", 1)[1])
+    if not msg.strip():
+        await update.message.reply_text("Введите текст.\n\n" + BROADCAST_USAGE)
+        return
+
+    try:
+        where_sql, where_params = build_segment_where(filters)
+    except ValueError as e:
+        await update.message.reply_text(f"Неверный фильтр: {e}\n\n{BROADCAST_USAGE}")
+        return
+
+    segment = describe_segment(filters)
+
+    def _count(cur):
+        cur.execute(f"SELECT COUNT(*) FROM users WHERE {where_sql}", where_params)
+        return int(cur.fetchone()[0] or 0)
+
+    def _create_draft(cur):
+        cur.execute(
+            """
+            INSERT INTO broadcast_jobs (text, created_by, status, filters, segment)
+            VALUES (%s, %s, 'draft', %s, %s)
+            RETURNING id
+            """,
+            (msg, update.effective_user.id, Json(filters), segment),
+        )
+        return cur.fetchone()[0]
+
+    try:
+        recipients = await run_db(_count, replica=True)
+        job_id = await run_db(_create_draft)
+
+        keyboard = InlineKeyboardMarkup(
+            [[
+                InlineKeyboardButton("✅ Отправить", callback_data=f"bc:send:{job_id}"),
+                InlineKeyboardButton("❌ Отмена", callback_data=f"bc:drop:{job_id}"),
+            ]]
+        )
+        await update.message.reply_text(
+            f"📣 Рассылка #{job_id}\n"
+            f"Сегмент: {segment}\n"
+            f"Получателей: {recipients}\n"
+            f"Примерное время отправки: ~{estimate_send_minutes(recipients)} мин\n\n"
+            f"Текст:\n{msg}",
+            reply_markup=keyboard,
+        )
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+
+async def broadcast_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id not in ADMINS:
+        await query.answer()
+        return
+
+    try:
+        _, action, raw_id = query.data.split(":")
+        job_id = int(raw_id)
+    except ValueError:
+        await query.answer()
+        return
+
+    def _drop(cur):
+        cur.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled', updated_at = %s WHERE id = %s AND status = 'draft' RETURNING id",
+            (utcnow(), job_id),
+        )
+        return cur.fetchone() is not None
+
+    def _start(cur):
+        cur.execute(
+            "SELECT filters FROM broadcast_jobs WHERE id = %s AND status = 'draft' FOR UPDATE",
+            (job_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        # The segment is evaluated now, at confirmation time.
+        where_sql, where_params = build_segment_where(row[0] or {})
+        cur.execute(
+            f"""
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT %s, user_id FROM users WHERE {where_sql}
+            """,
+            [job_id] + where_params,
+        )
+        total = cur.rowcount
+        cur.execute(
+            """
+            UPDATE broadcast_jobs
+            SET status = 'running', total = %s, created_at = %s, updated_at = %s
+            WHERE id = %s
+            """,
+            (total, utcnow(), utcnow(), job_id),
+        )
+        return total
+
+    try:
+        await query.answer()
+        if action == "drop":
+            dropped = await run_db(_drop)
+            await query.edit_message_text(
+                f"❌ Рассылка #{job_id} отменена." if dropped else f"Рассылка #{job_id} уже обработана."
+            )
+            return
+
+        total = await run_db(_start, timeout=max(DB_QUERY_TIMEOUT, 60))
+        if total is None:
+            await query.edit_message_text(f"Рассылка #{job_id} уже обработана.")
+            return
+
+        await query.edit_message_text(
+            f"⏳ Рассылка #{job_id} поставлена в очередь: {total} получателей, "
+            f"~{estimate_send_minutes(total)} мин.\n"
+            f"Прогресс: /broadcast_status {job_id}\n"
+            f"Отмена: /broadcast_cancel {job_id}"
+        )
+    except Exception as e:
+        print("broadcast_confirm_callback error:", e)
+
+
+def classify_send_error(error):
+    # -> (final, error_kind). Non-final errors leave the recipient pending
+    # until BROADCAST_MAX_ATTEMPTS is reached.
+    if isinstance(error, Forbidden):
+        return True, "blocked"
+    if isinstance(error, BadRequest):
+        return True, "chat_not_found" if "chat not found" in str(error).lower() else "bad_request"
+    if isinstance(error, RetryAfter):
+        return False, "flood"
+    if isinstance(error, NetworkError):
+        return False, "network"
+    return True, "other"
+
+
+async def broadcast_sender_job(context: ContextTypes.DEFAULT_TYPE):
+    # Sends the next BROADCAST_RATE * BROADCAST_TICK_SECONDS messages of the
+    # oldest running broadcast. Delivery state lives in broadcast_recipients,
+    # so after a restart the job simply continues with what is still pending.
+    batch_size = max(1, int(BROADCAST_RATE * BROADCAST_TICK_SECONDS))
+
+    def _claim(cur):
+        cur.execute("SELECT id, text FROM broadcast_jobs WHERE status = 'running' ORDER BY id LIMIT 1")
+        job = cur.fetchone()
+        if not job:
+            return None
+
+        cur.execute(
+            """
+            SELECT r.user_id, r.attempts, COALESCE(u.is_reachable, FALSE)
+            FROM broadcast_recipients r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            WHERE r.job_id = %s AND r.status = 'pending'
+            ORDER BY r.user_id
+            LIMIT %s
+            """,
+            (job[0], batch_size),
+        )
+        return job[0], job[1], cur.fetchall()
+
+    try:
+        claimed = await run_db(_claim)
+    except Exception as e:
+        print("broadcast_sender_job error:", e)
+        return
+    if not claimed:
+        return
+
+    job_id, text, recipients = claimed
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
-            if not rows:
-                await update.message.reply_text("Лидерборд пока пуст.")
-                return
+    async def _send(user_id, attempts, reachable):
+        if not reachable:
+            return job_id, user_id, "failed", attempts, "unreachable", None, None
+        async with semaphore:
+            try:
+                await context.bot.send_message(user_id, text, rate_limit_args={"priority": PRIORITY_BULK})
+                return job_id, user_id, "sent", attempts + 1, None, None, utcnow()
+            except Exception as e:
+                final, kind = classify_send_error(e)
+                if not final and attempts + 1 < BROADCAST_MAX_ATTEMPTS:
+                    return job_id, user_id, "pending", attempts + 1, kind, str(e)[:500], None
+                return job_id, user_id, "failed", attempts + 1, kind, str(e)[:500], None
 
-            msg = "🏆 <b>Лидерборд</b>\n"
-            for i, (first_name, username, stars) in enumerate(rows, 1):
-                name = first_name or display_username(username)
-                msg += f"{i}. <b>{name}</b> — {stars}⭐\n"
+    results = await asyncio.gather(*(_send(*recipient) for recipient in recipients))
 
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-            ])
-            await update.message.reply_text(
-                msg,
-                parse_mode=ParseMode.HTML,
-                reply_markup=keyboard,
+    def _save(cur):
+        if results:
+            execute_values(
+                cur,
+                """
+                UPDATE broadcast_recipients AS r
+                SET status = v.status,
+                    attempts = v.attempts,
+                    error_kind = v.error_kind,
+                    error = v.error,
+                    sent_at = v.sent_at
+                FROM (VALUES %s) AS v(job_id, user_id, status, attempts, error_kind, error, sent_at)
+                WHERE r.job_id = v.job_id
+                  AND r.user_id = v.user_id
+                  AND r.status = 'pending'
+                """,
+                results,
+                template="(%s::int, %s::bigint, %s::text, %s::int, %s::text, %s::text, %s::timestamp)",
+                page_size=len(results),
             )
-        except Exception as e:
-            await update.message.reply_text(f"Ошибка: {e}")
-        return
 
-    if text.startswith("🌠 Звёздное Колесо"):
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ])
-        await update.message.reply_text(
-            "Откройте WebApp кнопкой в меню ниже 👇",
-            reply_markup=keyboard,
+        sent = sum(1 for row in results if row[2] == "sent")
+        failed = sum(1 for row in results if row[2] == "failed")
+        now = utcnow()
+        cur.execute(
+            """
+            UPDATE broadcast_jobs
+            SET sent = sent + %s,
+                failed = failed + %s,
+                updated_at = %s,
+                status = CASE
+                    WHEN status = 'running' AND NOT EXISTS (
+                        SELECT 1 FROM broadcast_recipients
+                        WHERE job_id = %s AND status = 'pending'
+                    ) THEN 'done'
+                    ELSE status
+                END
+            WHERE id = %s
+            RETURNING status, created_by, sent, failed
+            """,
+            (sent, failed, now, job_id, job_id),
         )
+        row = cur.fetchone()
+        if row and row[0] == "done":
+            cur.execute(
+                "UPDATE broadcast_jobs SET finished_at = %s WHERE id = %s AND finished_at IS NULL RETURNING id",
+                (now, job_id),
+            )
+            if cur.fetchone():
+                return row
+        return None
+
+    try:
+        finished = await run_db(_save)
+    except Exception as e:
+        print("broadcast_sender_job save error:", e)
         return
 
-    await update.message.reply_text("Используйте кнопки меню.")
+    if finished:
+        _, created_by, sent, failed = finished
+        if created_by:
+            await enqueue_message(
+                created_by,
+                f"✅ Рассылка #{job_id} завершена.\nДоставлено: {sent}\nНе доставлено: {failed}",
+                "broadcast_done",
+            )
 
 
-async def sponsor_slots_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS:
+outbox_stats = {
+    "sent": 0,
+    "failed": 0,
+    "retried": 0,
+    "errors": 0,
+    "backlog": 0,
+    "oldest_age": 0.0,
+    "last_ms": 0.0,
+}
+
+
+async def outbox_dispatcher_job(context: ContextTypes.DEFAULT_TYPE):
+    # Sends due outbound_messages. Failed sends are retried with exponential
+    # backoff until OUTBOX_MAX_ATTEMPTS; errors that will not go away
+    # (blocked bot, bad request) fail the message right away.
+    # Claimed rows are leased by moving next_attempt_at OUTBOX_LEASE_SECONDS
+    # ahead, so another dispatcher skips them; if this one dies before saving
+    # the result they are sent again after the lease: at-least-once delivery.
+    started = time.perf_counter()
+
+    def _claim(cur):
+        now = utcnow()
+        cur.execute(
+            """
+            UPDATE outbound_messages
+            SET next_attempt_at = %s
+            WHERE id IN (
+                SELECT id
+                FROM outbound_messages
+                WHERE status = 'pending' AND next_attempt_at <= %s
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, text, parse_mode, reply_markup, attempts
+            """,
+            (now + timedelta(seconds=OUTBOX_LEASE_SECONDS), now, OUTBOX_BATCH_SIZE),
+        )
+        return cur.fetchall()
+
+    try:
+        messages = await run_db(_claim)
+    except Exception as e:
+        outbox_stats["errors"] += 1
+        print("outbox_dispatcher_job error:", e)
         return
 
+    async def _send(message_id, chat_id, text, parse_mode, reply_markup, attempts):
+        try:
+            await context.bot.send_message(
+                chat_id,
+                text,
+                parse_mode=parse_mode,
+                reply_markup=InlineKeyboardMarkup.de_json(reply_markup, context.bot) if reply_markup else None,
+            )
+            return message_id, "sent", attempts + 1, None, None, utcnow()
+        except Exception as e:
+            final, kind = classify_send_error(e)
+            error = f"{kind}: {e}"[:500]
+            if not final and attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+                delay = OUTBOX_RETRY_BASE_SECONDS * (2 ** attempts)
+                return message_id, "pending", attempts + 1, utcnow() + timedelta(seconds=delay), error, None
+            return message_id, "failed", attempts + 1, None, error, None
+
+    results = await asyncio.gather(*(_send(*message) for message in messages))
+
+    def _save(cur):
+        if results:
+            execute_values(
+                cur,
+                """
+                UPDATE outbound_messages AS m
+                SET status = v.status,
+                    attempts = v.attempts,
+                    next_attempt_at = COALESCE(v.next_attempt_at, m.next_attempt_at),
+                    last_error = v.last_error,
+                    sent_at = v.sent_at
+                FROM (VALUES %s) AS v(id, status, attempts, next_attempt_at, last_error, sent_at)
+                WHERE m.id = v.id
+                """,
+                results,
+                template="(%s::bigint, %s::text, %s::int, %s::timestamp, %s::text, %s::timestamp)",
+                page_size=len(results),
+            )
+        cur.execute("SELECT COUNT(*), MIN(created_at) FROM outbound_messages WHERE status = 'pending'")
+        return cur.fetchone()
+
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT
-                        s.slot_no,
-                        s.sponsor_type,
-                        s.channel_username,
-                        s.order_id,
-                        s.is_active,
-                        o.target_subscribers,
-                        o.counted_subscribers,
-                        o.active_subscribers
-                    FROM sponsor_slots s
-                    LEFT JOIN sponsor_orders o ON o.id = s.order_id
-                    ORDER BY s.slot_no
-                    """
-                )
-                rows = cur.fetchall()
+        backlog, oldest = await run_db(_save)
+    except Exception as e:
+        outbox_stats["errors"] += 1
+        print("outbox_dispatcher_job save error:", e)
+        return
 
-        text = "📢 <b>Слоты спонсоров</b>\n\n"
-        for row in rows:
-            slot_no, sponsor_type, channel_username, order_id, is_active, target, counted, active = row
+    for row in results:
+        if row[1] == "sent":
+            outbox_stats["sent"] += 1
+        elif row[1] == "failed":
+            outbox_stats["failed"] += 1
+        else:
+            outbox_stats["retried"] += 1
+    outbox_stats["backlog"] = int(backlog or 0)
+    outbox_stats["oldest_age"] = (utcnow() - to_naive_utc(oldest)).total_seconds() if oldest else 0.0
+    outbox_stats["last_ms"] = (time.perf_counter() - started) * 1000
 
-            if not is_active or not channel_username:
-                text += f"Слот {slot_no}: пусто\n\n"
-                continue
 
-            if sponsor_type == "main":
-                text += f"Слот {slot_no} (основной): {channel_username}\n\n"
-            else:
-                text += (
-                    f"Слот {slot_no} (временный): {channel_username}\n"
-                    f"Заказ #{order_id}\n"
-                    f"Привлечено: {counted or 0}/{target or 0}\n"
-                    f"Удержано: {active or 0}\n\n"
-                )
+async def outbox_cleanup_job(context: ContextTypes.DEFAULT_TYPE):
+    def _cleanup(cur):
+        cur.execute(
+            "DELETE FROM outbound_messages WHERE status <> 'pending' AND created_at < %s",
+            (utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS),),
+        )
 
-        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    try:
+        await run_db(_cleanup, timeout=max(DB_QUERY_TIMEOUT, 60))
     except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
+        print("outbox_cleanup_job error:", e)
 
 
-async def sponsor_queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def broadcast_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMINS:
         return
 
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT id, username, channel_username, priority_level, stars_amount, status, created_at
-                    FROM sponsor_orders
-                    WHERE status IN ('waiting_link', 'approved', 'active')
-                    ORDER BY
-                        CASE
-                            WHEN status = 'active' THEN 0
-                            WHEN status = 'approved' THEN 1
-                            ELSE 2
-                        END,
-                        priority_level DESC,
-                        created_at ASC
-                    """
-                )
-                rows = cur.fetchall()
+    job_id = None
+    if context.args:
+        try:
+            job_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /broadcast_status [id]")
+            return
 
-        if not rows:
-            await update.message.reply_text("Очередь пуста.")
+    def _load(cur):
+        if job_id is None:
+            cur.execute("SELECT id FROM broadcast_jobs ORDER BY id DESC LIMIT 1")
+            row = cur.fetchone()
+            if not row:
+                return None
+            target = row[0]
+        else:
+            target = job_id
+
+        cur.execute(
+            """
+            SELECT id, status, total, sent, failed, created_at, updated_at, finished_at, segment
+            FROM broadcast_jobs
+            WHERE id = %s
+            """,
+            (target,),
+        )
+        job = cur.fetchone()
+        if not job:
+            return None
+
+        cur.execute(
+            """
+            SELECT COALESCE(error_kind, '—'), COUNT(*)
+            FROM broadcast_recipients
+            WHERE job_id = %s AND status = 'failed'
+            GROUP BY 1
+            ORDER BY 2 DESC
+            """,
+            (target,),
+        )
+        return job, cur.fetchall()
+
+    try:
+        loaded = await run_db(_load)
+        if not loaded:
+            await update.message.reply_text("Рассылка не найдена.")
             return
 
-        text = "🗂 <b>Очередь / активные заказы</b>\n\n"
-        for row in rows:
-            order_id, username, channel_username, priority_level, stars_amount, status, created_at = row
-            text += (
-                f"#{order_id} | {display_username(username)}\n"
-                f"Канал: {channel_username or 'не указан'}\n"
-                f"Статус: {status}\n"
-                f"Приоритет: {'высокий' if priority_level == 1 else 'обычный'}\n"
-                f"Оплачено: {stars_amount}⭐\n\n"
+        (jid, status, total, sent, failed, created_at, updated_at, finished_at, segment), breakdown = loaded
+        status_names = {
+            "draft": "📝 ждёт подтверждения",
+            "running": "⏳ идёт",
+            "cancelled": "⛔️ отменена",
+            "done": "✅ завершена",
+        }
+        done = sent + failed
+        percent = done / total * 100 if total else 100.0
+        text = (
+            f"📣 <b>Рассылка #{jid}</b> — {status_names.get(status, status)}\n"
+            f"Сегмент: {html.escape(segment or 'все пользователи')}\n"
+            f"Обработано: {done}/{total} ({percent:.1f}%)\n"
+            f"Доставлено: {sent} | Не доставлено: {failed}\n"
+        )
+
+        end = finished_at or updated_at
+        elapsed = (end - created_at).total_seconds() if end and created_at else 0
+        if elapsed > 0 and done:
+            rate = done / elapsed
+            text += f"Скорость: {rate * 60:.0f} сообщ./мин"
+            if status == "running" and total > done:
+                text += f", осталось ~{int((total - done) / rate / 60) + 1} мин"
+            text += "\n"
+
+        if breakdown:
+            kind_names = {
+                "blocked": "бот заблокирован",
+                "chat_not_found": "чат не найден",
+                "bad_request": "ошибка запроса",
+                "flood": "лимит Telegram",
+                "network": "сеть",
+                "other": "прочее",
+            }
+            text += "\n<b>Ошибки:</b>\n" + "".join(
+                f"• {kind_names.get(kind, kind)}: {count}\n" for kind, count in breakdown
             )
 
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -1926,151 +3887,214 @@ async def sponsor_queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Ошибка: {e}")
 
 
-async def set_main_sponsor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def broadcast_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMINS:
         return
 
-    if len(context.args) < 2:
-        await update.message.reply_text("Использование: /set_main_sponsor <1|2> <@channel>")
-        return
-
     try:
-        slot_no = int(context.args[0])
-        channel_username = normalize_channel_username(context.args[1])
+        job_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /broadcast_cancel <id>")
+        return
 
-        if slot_no not in (1, 2):
-            await update.message.reply_text("Можно указать только слот 1 или 2.")
-            return
+    def _cancel(cur):
+        now = utcnow()
+        cur.execute(
+            """
+            UPDATE broadcast_jobs
+            SET status = 'cancelled', updated_at = %s, finished_at = %s
+            WHERE id = %s AND status = 'running'
+            RETURNING sent, failed, total
+            """,
+            (now, now, job_id),
+        )
+        return cur.fetchone()
 
-        member = await context.bot.get_chat_member(channel_username, context.bot.id)
-        if member.status not in ["administrator", "creator"]:
-            await update.message.reply_text("Бот не является администратором этого канала.")
+    try:
+        row = await run_db(_cancel)
+        if not row:
+            await update.message.reply_text(f"Рассылка #{job_id} не выполняется.")
             return
-
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    UPDATE sponsor_slots
-                    SET channel_username = %s,
-                        is_active = TRUE,
-                        order_id = NULL
-                    WHERE slot_no = %s
-                    """,
-                    (channel_username, slot_no),
-                )
-                conn.commit()
-
+        sent, failed, total = row
         await update.message.reply_text(
-            f"✅ Основной спонсор для слота {slot_no} установлен: {channel_username}"
+            f"⛔️ Рассылка #{job_id} отменена. Обработано {sent + failed}/{total}."
         )
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
 
 
-async def remove_temp_sponsor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMINS:
         return
 
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT order_id FROM sponsor_slots WHERE slot_no = 3")
-                row = cur.fetchone()
-                order_id = row[0] if row else None
+        def _load_stats(cur):
+            cur.execute("SELECT COUNT(*) FROM users")
+            total_users = cur.fetchone()[0]
 
-                if order_id:
-                    cur.execute(
-                        """
-                        UPDATE sponsor_orders
-                        SET status = 'completed',
-                            completed_at = %s
-                        WHERE id = %s
-                        """,
-                        (utcnow(), order_id),
-                    )
+            cur.execute("SELECT COALESCE(SUM(tickets), 0) FROM users")
+            total_stars = cur.fetchone()[0] or 0
 
-                cur.execute(
-                    """
-                    UPDATE sponsor_slots
-                    SET channel_username = NULL,
-                        order_id = NULL,
-                        is_active = FALSE
-                    WHERE slot_no = 3
-                    """
-                )
-                conn.commit()
+            cur.execute("SELECT COUNT(*) FROM users WHERE COALESCE(activated, FALSE) = TRUE")
+            activated_users = cur.fetchone()[0]
+            return total_users, total_stars, activated_users
 
-        await update.message.reply_text("✅ Временный спонсор удалён из слота 3.")
-        await place_next_temp_order(context)
+        total_users, total_stars, activated_users = await run_db(_load_stats, replica=True)
+
+        text = (
+            f"📊 <b>СТАТИСТИКА БОТА:</b>\n\n"
+            f"👥 <b>Всего пользователей:</b> {total_users}\n"
+            f"🚀 <b>Активировали колесо:</b> {activated_users}\n"
+            f"⭐ <b>Всего звёзд в системе:</b> {total_stars}\n"
+        )
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
+        await update.message.reply_text(f"Ошибка получения статистики: {e}")
 
 
-async def check_sponsor_progress_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS:
-        return
+def build_db_pool_metrics_text():
+    pool_stats = get_db_pool().stats()
+    return (
+        f"🗄 <b>Пул соединений БД</b>\n"
+        f"Открыто: {pool_stats['size']}/{pool_stats['max']} "
+        f"(занято {pool_stats['in_use']}, свободно {pool_stats['idle']})\n"
+        f"Выдач: {pool_stats['checkouts']} | Ожиданий: {pool_stats['waits']} | "
+        f"Таймаутов: {pool_stats['timeouts']}\n"
+        f"Ожидание: ср. {pool_stats['wait_avg_ms']:.1f} мс, макс. {pool_stats['wait_max_ms']:.1f} мс | "
+        f"Пул исчерпан: {pool_stats['saturated']} раз\n"
+        f"Создано: {pool_stats['created']} | Закрыто: {pool_stats['discarded']} | "
+        f"Неудачных проверок: {pool_stats['healthcheck_failures']}\n"
+    )
 
-    await recount_temp_order_progress(context)
-    await update.message.reply_text("✅ Прогресс временного спонсора обновлён.")
 
+def build_replica_metrics_text():
+    if not READ_DATABASE_URL:
+        return "📖 <b>Реплика чтения</b>: не настроена\n"
 
-async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS:
-        return
+    lag = replica_state["lag_seconds"]
+    lag_text = f"{lag:.1f} с" if lag is not None else "—"
+    return (
+        f"📖 <b>Реплика чтения</b>: {'✅ доступна' if replica_state['healthy'] else '⚠️ недоступна'}\n"
+        f"Отставание: {lag_text} (лимит {READ_REPLICA_MAX_LAG_SECONDS:.0f} с)\n"
+        f"Чтений с реплики: {replica_state['reads']} | На основную БД: {replica_state['fallbacks']}\n"
+        + (f"Последняя ошибка: {html.escape(replica_state['last_error'])}\n" if replica_state["last_error"] else "")
+    )
 
-    if not context.args:
-        await update.message.reply_text("Введите текст.")
-        return
 
-    msg = update.message.text.split(" ", 1)[1]
-    await update.message.reply_text("⏳ Рассылка...")
+def build_subscription_cache_metrics_text():
+    sc = subscription_cache.stats
+    lookups = sc["hits"] + sc["misses"]
+    hit_rate = sc["hits"] / lookups * 100 if lookups else 0.0
+    return (
+        f"📡 <b>Кэш подписок</b>\n"
+        f"Записей: {subscription_cache.size()} | Попаданий: {sc['hits']} | "
+        f"Промахов: {sc['misses']} ({hit_rate:.1f}% попаданий)\n"
+        f"Сброшено: {sc['invalidations']} | Вытеснено: {sc['evictions']}\n"
+        f"Из локальной таблицы: {subscription_state_stats['local_hits']} | "
+        f"Запросов get_chat_member: {subscription_state_stats['api_checks']} "
+        f"(ошибок {subscription_state_stats['api_errors']}, одновременно до "
+        f"{subscription_state_stats['max_in_flight']}/{SUBSCRIPTION_CHECK_CONCURRENCY}) | "
+        f"Событий chat_member: {subscription_state_stats['events']}\n"
+        f"Объединено одинаковых запросов: {chat_member_flight.stats['shared']} "
+        f"из {chat_member_flight.stats['calls']} (сейчас в полёте {chat_member_flight.in_flight()})\n"
+    )
 
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id FROM users")
-                users = cur.fetchall()
 
-        count = 0
-        for (uid,) in users:
-            try:
-                await context.bot.send_message(uid, msg)
-                count += 1
-                await asyncio.sleep(0.05)
-            except Exception:
-                pass
+def build_channel_breaker_metrics_text():
+    cb = channel_breaker.stats
+    text = (
+        f"🔌 <b>Доступ к каналам спонсоров</b>\n"
+        f"Отключений: {cb['opened']} | Восстановлений: {cb['closed']} | "
+        f"Пропущено проверок: {cb['skipped']} | Пробных запросов: {cb['probes']}\n"
+    )
+    for channel, error in channel_breaker.open_channels().items():
+        text += f"⚠️ {html.escape(channel)}: {html.escape(error or '')}\n"
+    return text
 
-        await update.message.reply_text(f"✅ Доставлено: {count}")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
 
+def build_rate_limiter_metrics_text():
+    rl = telegram_rate_limiter.snapshot()
+    return (
+        f"🚦 <b>Лимитер Telegram API</b>\n"
+        f"В очереди: {rl['waiting_interactive']} интерактивных, {rl['waiting_bulk']} массовых "
+        f"(макс. {rl['max_waiting']})\n"
+        f"Запросов: {rl['requests']} | Задержано: {rl['throttled']} | "
+        f"429: {rl['retry_after']} | Повторов: {rl['retries']} | Потеряно: {rl['gave_up']}\n"
+        f"Пауза после 429: {rl['paused_for']:.1f} с | Чатов в учёте: {rl['chat_buckets']}\n"
+        f"Недоступных чатов: {rl['unreachable']}\n"
+    )
 
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMINS:
-        return
 
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users")
-                total_users = cur.fetchone()[0]
+def build_referral_job_metrics_text():
+    rj = referral_job_stats
+    return (
+        f"👥 <b>Проверка рефералов</b>\n"
+        f"Запусков: {rj['runs']} | Ошибок: {rj['errors']} | В приоритетной очереди: {len(referral_recheck_queue)}\n"
+        f"Проверено рефералов: {rj['checked']} | Пересчитано пригласивших: {rj['referrers']} "
+        f"(вне очереди {rj['priority']})\n"
+        f"Последний запуск: {rj['last_checked']} рефералов, {rj['last_api_calls']} запросов API "
+        f"из {REFERRAL_RECHECK_BUDGET_PER_MINUTE}/мин, {rj['last_ms']:.0f} мс\n"
+    )
+
+
+def build_reachability_metrics_text():
+    rs = reachability.stats
+    return (
+        f"🚫 <b>Заблокировавшие бота</b>\n"
+        f"Отмечено: {rs['marked']} | Записано: {rs['written']} | В буфере: {reachability.pending_count()} | "
+        f"Вернулись: {rs['cleared']} | Ошибок: {rs['errors']}\n"
+    )
+
+
+def build_outbox_metrics_text():
+    ob = outbox_stats
+    return (
+        f"📬 <b>Очередь уведомлений</b>\n"
+        f"В очереди: {ob['backlog']} | Самому старому: {ob['oldest_age']:.0f} с\n"
+        f"Отправлено: {ob['sent']} | Повторов: {ob['retried']} | Не доставлено: {ob['failed']} | "
+        f"Ошибок: {ob['errors']} | Последний проход: {ob['last_ms']:.0f} мс\n"
+    )
+
+
+def build_heartbeat_metrics_text():
+    hb = heartbeat_buffer.stats
+    return (
+        f"💓 <b>Отметки активности</b>\n"
+        f"В буфере: {heartbeat_buffer.pending_count()} | Сбросов: {hb['flushes']} | "
+        f"Строк записано: {hb['rows']} | Ошибок: {hb['errors']}\n"
+        f"Последний сброс: {hb['last_size']} строк за {hb['last_ms']:.1f} мс, "
+        f"макс. {hb['max_ms']:.1f} мс\n"
+    )
 
-                cur.execute("SELECT COALESCE(SUM(tickets), 0) FROM users")
-                total_stars = cur.fetchone()[0] or 0
 
-                cur.execute("SELECT COUNT(*) FROM users WHERE COALESCE(activated, FALSE) = TRUE")
-                activated_users = cur.fetchone()[0]
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
 
+    try:
         text = (
-            f"📊 <b>СТАТИСТИКА БОТА:</b>\n\n"
-            f"👥 <b>Всего пользователей:</b> {total_users}\n"
-            f"🚀 <b>Активировали колесо:</b> {activated_users}\n"
-            f"⭐ <b>Всего звёзд в системе:</b> {total_stars}\n"
+            "📈 <b>Метрики бота</b>\n\n"
+            + build_db_pool_metrics_text()
+            + "\n"
+            + build_replica_metrics_text()
+            + "\n"
+            + build_subscription_cache_metrics_text()
+            + "\n"
+            + build_channel_breaker_metrics_text()
+            + "\n"
+            + build_rate_limiter_metrics_text()
+            + "\n"
+            + build_referral_job_metrics_text()
+            + "\n"
+            + build_heartbeat_metrics_text()
+            + "\n"
+            + build_reachability_metrics_text()
+            + "\n"
+            + build_outbox_metrics_text()
         )
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     except Exception as e:
-        await update.message.reply_text(f"Ошибка получения статистики: {e}")
+        await update.message.reply_text(f"Ошибка получения метрик: {e}")
 
 
 async def weekly_bonus_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2081,17 +4105,18 @@ async def weekly_bonus_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     skipped_count = 0
 
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id FROM users")
-                users = [row[0] for row in cur.fetchall()]
-
-        for user_id in users:
-            ok, _ = await process_weekly_hold_bonus(user_id, context)
-            if ok:
-                success_count += 1
-            else:
-                skipped_count += 1
+        pages = stream_rows(
+            "SELECT user_id FROM users WHERE is_reachable = TRUE AND user_id > %s ORDER BY user_id LIMIT %s",
+            replica=True,
+        )
+        async with contextlib.aclosing(pages):
+            async for rows in pages:
+                for (user_id,) in rows:
+                    ok, _ = await process_weekly_hold_bonus(user_id, context)
+                    if ok:
+                        success_count += 1
+                    else:
+                        skipped_count += 1
 
         await update.message.reply_text(
             f"✅ Недельный бонус обработан.\n"
@@ -2448,16 +4473,16 @@ async def reset_weekly_hold_bonuses_cmd(update: Update, context: ContextTypes.DE
         return
 
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    UPDATE users
-                    SET weekly_hold_bonus_count = 0,
-                        last_hold_bonus_at = NULL
-                    """
-                )
-                conn.commit()
+        def _reset(cur):
+            cur.execute(
+                """
+                UPDATE users
+                SET weekly_hold_bonus_count = 0,
+                    last_hold_bonus_at = NULL
+                """
+            )
+
+        await run_db(_reset)
 
         await update.message.reply_text(
             "✅ Недельные бонусы сброшены. Пользователи снова смогут получать бонус до 4 недель."
@@ -2471,11 +4496,48 @@ def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    async def _post_shutdown(application):
+        await flush_heartbeats()
+        await flush_reachability()
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(telegram_rate_limiter)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
+    app.job_queue.run_repeating(flush_heartbeats, interval=HEARTBEAT_FLUSH_SECONDS, first=HEARTBEAT_FLUSH_SECONDS)
+    app.job_queue.run_repeating(flush_reachability, interval=HEARTBEAT_FLUSH_SECONDS, first=HEARTBEAT_FLUSH_SECONDS)
+    app.job_queue.run_repeating(outbox_dispatcher_job, interval=OUTBOX_TICK_SECONDS, first=OUTBOX_TICK_SECONDS)
+    app.job_queue.run_repeating(outbox_cleanup_job, interval=3600, first=600)
+    app.job_queue.run_repeating(
+        recount_temp_order_progress,
+        interval=ORDER_RECOUNT_INTERVAL_SECONDS,
+        first=ORDER_RECOUNT_INTERVAL_SECONDS,
+    )
+    app.job_queue.run_repeating(
+        broadcast_sender_job,
+        interval=BROADCAST_TICK_SECONDS,
+        first=BROADCAST_TICK_SECONDS,
+    )
+    app.job_queue.run_repeating(
+        sponsor_audit_job,
+        interval=SPONSOR_AUDIT_INTERVAL_SECONDS,
+        first=SPONSOR_AUDIT_INTERVAL_SECONDS,
+    )
+    app.job_queue.run_repeating(
+        referral_revalidation_job,
+        interval=REFERRAL_RECHECK_INTERVAL_SECONDS,
+        first=5,
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status_cmd))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_cmd))
     app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
     app.add_handler(CommandHandler("weekly_bonus", weekly_bonus_all))
     app.add_handler(CommandHandler("reset_weekly_hold_bonuses", reset_weekly_hold_bonuses_cmd))
     app.add_handler(CommandHandler("stop", stop_bot))
@@ -2486,13 +4548,20 @@ def main():
     app.add_handler(CommandHandler("set_main_sponsor", set_main_sponsor_cmd))
     app.add_handler(CommandHandler("remove_temp_sponsor", remove_temp_sponsor_cmd))
     app.add_handler(CommandHandler("check_sponsor_progress", check_sponsor_progress_cmd))
+    app.add_handler(CommandHandler("audit_sponsor", audit_sponsor_cmd))
 
+    app.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(ChatMemberHandler(bot_blocked_update, ChatMemberHandler.MY_CHAT_MEMBER))
     app.add_handler(CallbackQueryHandler(faq_callback, pattern=r"^faq:"))
+    app.add_handler(CallbackQueryHandler(broadcast_confirm_callback, pattern=r"^bc:"))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_menu_handler))
 
     print("Бот запущен...")
-    app.run_polling()
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        close_db_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import argparse
+import os
+import re
+import sys
+from pathlib import Path
+
+import psycopg2
+import psycopg2.errors
+from dotenv import load_dotenv
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent / "migrations"
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+MIGRATION_LOCK_ID = 4_815_162_342
+NO_TRANSACTION_MARKER = "-- migrate:no-transaction"
+CONCURRENT_INDEX_RE = re.compile(
+    r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)",
+    re.IGNORECASE,
+)
+
+
+def load_migrations():
+    migrations = []
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if not match:
+            raise RuntimeError(f"Bad migration file name: {path.name}")
+        migrations.append((int(match.group(1)), match.group(2), path))
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Duplicate migration version in migrations/")
+
+    return sorted(migrations)
+
+
+def split_statements(sql):
+    statements = []
+    for chunk in sql.split(";\n"):
+        lines = [line for line in chunk.splitlines() if line.strip() and not line.strip().startswith("--")]
+        if lines:
+            statements.append("\n".join(lines).rstrip(";"))
+    return statements
+
+
+def find_invalid_index(cur, index_name):
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+          AND pg_table_is_visible(c.oid)
+          AND NOT i.indisvalid
+        """,
+        (index_name,),
+    )
+    return cur.fetchone() is not None
+
+
+def run_migration(conn, version, name, path, log=print):
+    sql = path.read_text(encoding="utf-8")
+
+    if not sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                (version, name),
+            )
+        conn.commit()
+        return
+
+    # CREATE INDEX CONCURRENTLY and friends refuse to run inside a transaction
+    # block, so these files are executed statement by statement in autocommit.
+    # Every statement in such a file must be safe to re-run. A failed
+    # CREATE INDEX CONCURRENTLY leaves an INVALID index behind that
+    # IF NOT EXISTS would skip, so such leftovers are dropped and rebuilt.
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in split_statements(sql):
+                index_match = CONCURRENT_INDEX_RE.match(statement)
+                if index_match and find_invalid_index(cur, index_match.group(1)):
+                    log(f"Dropping invalid index {index_match.group(1)} left by an earlier run...")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_match.group(1)}")
+
+                cur.execute(statement)
+
+                if index_match and find_invalid_index(cur, index_match.group(1)):
+                    raise RuntimeError(
+                        f"Index {index_match.group(1)} is INVALID after migration {version:04d}_{name}"
+                    )
+            cur.execute(
+                "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                (version, name),
+            )
+    finally:
+        conn.autocommit = False
+
+
+def latest_version():
+    migrations = load_migrations()
+    return migrations[-1][0] if migrations else 0
+
+
+def get_schema_version(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            version = int(cur.fetchone()[0])
+        conn.commit()
+        return version
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return 0
+
+
+def apply_migrations(conn, log=print):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+            """
+        )
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute("SET statement_timeout = 0")
+    conn.commit()
+
+    applied = []
+    try:
+        current = get_schema_version(conn)
+
+        for version, name, path in load_migrations():
+            if version <= current:
+                continue
+
+            log(f"Applying migration {version:04d}_{name}...")
+            run_migration(conn, version, name, path, log=log)
+            applied.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("RESET statement_timeout")
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        conn.commit()
+
+    return applied
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Apply database schema migrations.")
+    parser.add_argument("command", choices=["status", "up"], nargs="?", default="status")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL") or os.getenv("MY_DATABASE_URL"))
+    args = parser.parse_args()
+
+    if not args.database_url:
+        print("DATABASE_URL is not set")
+        return 1
+
+    conn = psycopg2.connect(args.database_url)
+    try:
+        current = get_schema_version(conn)
+        pending = [(v, n) for v, n, _ in load_migrations() if v > current]
+
+        if args.command == "status":
+            print(f"Schema version: {current}")
+            if not pending:
+                print("No pending migrations.")
+            for version, name in pending:
+                print(f"Pending: {version:04d}_{name}")
+            return 0
+
+        applied = apply_migrations(conn)
+        print(f"Applied {len(applied)} migration(s). Schema version: {get_schema_version(conn)}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
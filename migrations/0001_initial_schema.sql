@@ -0,0 +1,115 @@
+-- Baseline schema: everything init_db() used to create and patch on every start.
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    referrer_id BIGINT NULL,
+    activated BOOLEAN DEFAULT FALSE,
+    all_subscribed INT DEFAULT 0,
+    tickets INT DEFAULT 0,
+    last_fortune_time TIMESTAMP NULL,
+    lifetime_ref_count INT DEFAULT 0,
+    weekly_hold_bonus_count INT DEFAULT 0,
+    last_hold_bonus_at TIMESTAMP NULL,
+    last_level_notified TEXT DEFAULT 'Bronze',
+    last_seen TIMESTAMP NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    welcome_spin_used BOOLEAN DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    referrer_id BIGINT,
+    referred_id BIGINT,
+    is_valid BOOLEAN DEFAULT FALSE,
+    checked_at TIMESTAMP NULL,
+    inactive_since TIMESTAMP NULL,
+    UNIQUE(referrer_id, referred_id)
+);
+
+CREATE TABLE IF NOT EXISTS channel_subscriptions (
+    user_id BIGINT,
+    channel_id TEXT,
+    subscribed_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (user_id, channel_id)
+);
+
+CREATE TABLE IF NOT EXISTS fortune_spins (
+    spin_id TEXT PRIMARY KEY,
+    user_id BIGINT,
+    prize_code TEXT,
+    created_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS exchange_requests (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT,
+    username TEXT,
+    exchange_type TEXT,
+    stars_amount INT,
+    status TEXT DEFAULT 'new',
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sponsor_slots (
+    slot_no INT PRIMARY KEY,
+    sponsor_type TEXT NOT NULL,
+    channel_username TEXT,
+    order_id INT NULL,
+    is_active BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sponsor_orders (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT,
+    username TEXT,
+    channel_username TEXT,
+    target_subscribers INT DEFAULT 100,
+    counted_subscribers INT DEFAULT 0,
+    active_subscribers INT DEFAULT 0,
+    priority_level INT DEFAULT 0,
+    stars_amount INT NOT NULL,
+    status TEXT DEFAULT 'waiting_link',
+    placed_in_slot BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT NOW(),
+    completed_at TIMESTAMP NULL
+);
+
+CREATE TABLE IF NOT EXISTS sponsor_order_members (
+    order_id INT NOT NULL,
+    user_id BIGINT NOT NULL,
+    counted_at TIMESTAMP DEFAULT NOW(),
+    still_subscribed BOOLEAN DEFAULT TRUE,
+    PRIMARY KEY (order_id, user_id)
+);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS activated BOOLEAN DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS all_subscribed INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tickets INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_fortune_time TIMESTAMP NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS active_ref_count INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS activation_bonus_percent INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS boost_percent INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS boost_spins_left INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS activation_reward_paid BOOLEAN DEFAULT FALSE;
+ALTER TABLE referrals ADD COLUMN IF NOT EXISTS inactive_since TIMESTAMP NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active_at TIMESTAMP NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS lifetime_ref_count INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS weekly_hold_bonus_count INT DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_hold_bonus_at TIMESTAMP NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_level_notified TEXT DEFAULT 'Bronze';
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS welcome_spin_used BOOLEAN DEFAULT FALSE;
+ALTER TABLE users DROP COLUMN IF EXISTS profile_badge;
+
+INSERT INTO sponsor_slots (slot_no, sponsor_type, is_active)
+VALUES
+    (1, 'main', FALSE),
+    (2, 'main', FALSE),
+    (3, 'temp', FALSE)
+ON CONFLICT (slot_no) DO NOTHING;
@@ -0,0 +1,3 @@
+-- Purchased extra spins, read and written by is_can_spin_server.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS paid_spins INT DEFAULT 0;
@@ -0,0 +1,24 @@
+-- migrate:no-transaction
+-- Indexes for the hot query patterns, built without blocking writes.
+-- check_query_plans.py verifies that the planner actually uses them.
+
+-- Leaderboard: ORDER BY COALESCE(tickets, 0) DESC, user_id LIMIT 10
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_leaderboard
+    ON users ((COALESCE(tickets, 0)) DESC, user_id);
+
+-- place_next_temp_order: next approved order not yet placed in slot 3
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sponsor_orders_queue
+    ON sponsor_orders (priority_level DESC, created_at)
+    WHERE status = 'approved' AND placed_in_slot = FALSE AND channel_username IS NOT NULL;
+
+-- Spin history per user
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fortune_spins_user_created
+    ON fortune_spins (user_id, created_at);
+
+-- Exchange requests waiting for an admin
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_exchange_requests_status
+    ON exchange_requests (status, created_at);
+
+-- Who invited this user (referrals is only indexed by referrer_id first)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referrals_referred
+    ON referrals (referred_id);
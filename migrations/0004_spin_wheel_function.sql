@@ -0,0 +1,175 @@
+-- One-round-trip spin for /api/spin.
+--
+-- Locks the user row, checks sponsors / subscription / activation / cooldown
+-- and paid spins, picks the prize from p_roll (uniform in [0, 1)) using the
+-- same weight formula as get_wheel_weights_by_bonus(), records the spin,
+-- consumes a boost charge and returns the new state. The wheel tables are
+-- passed in by the caller so the Python constants stay the only source.
+
+CREATE OR REPLACE FUNCTION spin_wheel(
+    p_user_id BIGINT,
+    p_spin_id TEXT,
+    p_now TIMESTAMP,
+    p_cooldown INTERVAL,
+    p_roll DOUBLE PRECISION,
+    p_codes TEXT[],
+    p_base_weights DOUBLE PRECISION[],
+    p_prize_stars INT[],
+    p_level_min_refs INT[],
+    p_level_bonus INT[]
+)
+RETURNS TABLE (
+    spin_status TEXT,
+    spin_prize TEXT,
+    spin_add_stars INT,
+    new_tickets INT,
+    new_paid_spins INT,
+    new_boost_percent INT,
+    new_boost_spins_left INT,
+    user_activation_bonus INT,
+    user_ref_count INT,
+    user_total_bonus INT,
+    wait_seconds INT,
+    sponsor_names TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user RECORD;
+    v_use_paid BOOLEAN := FALSE;
+    v_level_bonus INT := 0;
+    v_total_bonus INT;
+    v_mult DOUBLE PRECISION;
+    v_weights DOUBLE PRECISION[];
+    v_sum DOUBLE PRECISION := 0;
+    v_target DOUBLE PRECISION;
+    v_cumulative DOUBLE PRECISION := 0;
+    v_pick INT;
+    v_boost_percent INT;
+    v_boost_left INT;
+    v_tickets INT;
+    v_paid INT;
+    i INT;
+BEGIN
+    SELECT
+        COALESCE(u.tickets, 0) AS tickets,
+        u.last_fortune_time,
+        COALESCE(u.all_subscribed, 0) AS all_subscribed,
+        COALESCE(u.activated, FALSE) AS activated,
+        COALESCE(u.active_ref_count, 0) AS ref_count,
+        COALESCE(u.activation_bonus_percent, 0) AS activation_bonus,
+        COALESCE(u.boost_percent, 0) AS boost_percent,
+        COALESCE(u.boost_spins_left, 0) AS boost_spins_left,
+        COALESCE(u.paid_spins, 0) AS paid_spins
+    INTO v_user
+    FROM users u
+    WHERE u.user_id = p_user_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'user_not_found', NULL::TEXT, 0, 0, 0, 0, 0, 0, 0, 0, 0, NULL::TEXT;
+        RETURN;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1
+        FROM sponsor_slots s
+        WHERE s.is_active = TRUE
+          AND s.sponsor_type = 'main'
+          AND s.channel_username IS NOT NULL
+    ) THEN
+        RETURN QUERY SELECT 'not_configured', NULL::TEXT, 0, v_user.tickets, v_user.paid_spins,
+            v_user.boost_percent, v_user.boost_spins_left, v_user.activation_bonus, v_user.ref_count,
+            0, 0, NULL::TEXT;
+        RETURN;
+    END IF;
+
+    IF v_user.all_subscribed <> 1 THEN
+        RETURN QUERY
+            SELECT 'not_subscribed', NULL::TEXT, 0, v_user.tickets, v_user.paid_spins,
+                v_user.boost_percent, v_user.boost_spins_left, v_user.activation_bonus, v_user.ref_count,
+                0, 0,
+                (
+                    SELECT string_agg(s.channel_username, ', ' ORDER BY s.slot_no)
+                    FROM sponsor_slots s
+                    WHERE s.is_active = TRUE AND s.channel_username IS NOT NULL
+                );
+        RETURN;
+    END IF;
+
+    IF NOT v_user.activated THEN
+        RETURN QUERY SELECT 'not_activated', NULL::TEXT, 0, v_user.tickets, v_user.paid_spins,
+            v_user.boost_percent, v_user.boost_spins_left, v_user.activation_bonus, v_user.ref_count,
+            0, 0, NULL::TEXT;
+        RETURN;
+    END IF;
+
+    IF v_user.last_fortune_time IS NOT NULL AND p_now - v_user.last_fortune_time < p_cooldown THEN
+        IF v_user.paid_spins > 0 THEN
+            v_use_paid := TRUE;
+        ELSE
+            RETURN QUERY SELECT 'cooldown', NULL::TEXT, 0, v_user.tickets, v_user.paid_spins,
+                v_user.boost_percent, v_user.boost_spins_left, v_user.activation_bonus, v_user.ref_count,
+                0,
+                GREATEST(0, FLOOR(EXTRACT(EPOCH FROM p_cooldown - (p_now - v_user.last_fortune_time))))::INT,
+                NULL::TEXT;
+            RETURN;
+        END IF;
+    END IF;
+
+    FOR i IN 1 .. array_length(p_level_min_refs, 1) LOOP
+        IF v_user.ref_count >= p_level_min_refs[i] THEN
+            v_level_bonus := p_level_bonus[i];
+            EXIT;
+        END IF;
+    END LOOP;
+
+    v_total_bonus := v_user.activation_bonus + v_level_bonus + v_user.boost_percent;
+    v_mult := 1.0 + v_total_bonus / 100.0;
+
+    -- p_codes[1] is "nothing": it gets whatever weight the boosted prizes leave.
+    v_weights := ARRAY[0.0::DOUBLE PRECISION];
+    FOR i IN 2 .. array_length(p_codes, 1) LOOP
+        v_weights := v_weights || ROUND((p_base_weights[i] * v_mult)::NUMERIC, 2)::DOUBLE PRECISION;
+        v_sum := v_sum + v_weights[i];
+    END LOOP;
+    v_weights[1] := GREATEST(ROUND((100.0 - v_sum)::NUMERIC, 2)::DOUBLE PRECISION, 0.0);
+    v_sum := v_sum + v_weights[1];
+
+    v_target := p_roll * v_sum;
+    v_pick := array_length(p_codes, 1);
+    FOR i IN 1 .. array_length(p_codes, 1) LOOP
+        v_cumulative := v_cumulative + v_weights[i];
+        IF v_target < v_cumulative THEN
+            v_pick := i;
+            EXIT;
+        END IF;
+    END LOOP;
+
+    INSERT INTO fortune_spins (spin_id, user_id, prize_code, created_at)
+    VALUES (p_spin_id, p_user_id, p_codes[v_pick], p_now);
+
+    v_boost_percent := v_user.boost_percent;
+    v_boost_left := v_user.boost_spins_left;
+    IF v_boost_left > 0 THEN
+        v_boost_left := v_boost_left - 1;
+        IF v_boost_left <= 0 THEN
+            v_boost_left := 0;
+            v_boost_percent := 0;
+        END IF;
+    END IF;
+
+    UPDATE users u
+    SET tickets = COALESCE(u.tickets, 0) + p_prize_stars[v_pick],
+        paid_spins = CASE WHEN v_use_paid THEN COALESCE(u.paid_spins, 0) - 1 ELSE u.paid_spins END,
+        last_fortune_time = CASE WHEN v_use_paid THEN u.last_fortune_time ELSE p_now END,
+        boost_percent = v_boost_percent,
+        boost_spins_left = v_boost_left
+    WHERE u.user_id = p_user_id
+    RETURNING COALESCE(u.tickets, 0), COALESCE(u.paid_spins, 0) INTO v_tickets, v_paid;
+
+    RETURN QUERY SELECT 'ok', p_codes[v_pick], p_prize_stars[v_pick], v_tickets, v_paid,
+        v_boost_percent, v_boost_left, v_user.activation_bonus, v_user.ref_count,
+        v_total_bonus, 0, NULL::TEXT;
+END;
+$$;
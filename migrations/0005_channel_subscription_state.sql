@@ -0,0 +1,21 @@
+-- channel_subscriptions becomes the local copy of sponsor channel membership,
+-- kept current from chat_member updates and get_chat_member fallbacks.
+-- Rows written before this migration have updated_at = NULL and are
+-- re-verified once on first use.
+
+ALTER TABLE channel_subscriptions ADD COLUMN IF NOT EXISTS is_member BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE channel_subscriptions ADD COLUMN IF NOT EXISTS unsubscribed_at TIMESTAMPTZ;
+ALTER TABLE channel_subscriptions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ;
+ALTER TABLE channel_subscriptions ALTER COLUMN updated_at SET DEFAULT NOW();
+ALTER TABLE channel_subscriptions ALTER COLUMN subscribed_at DROP DEFAULT;
+
+-- Channel keys are stored as lower-case "@username" from now on.
+DELETE FROM channel_subscriptions a
+USING channel_subscriptions b
+WHERE a.user_id = b.user_id
+  AND lower(a.channel_id) = lower(b.channel_id)
+  AND a.ctid < b.ctid;
+
+UPDATE channel_subscriptions
+SET channel_id = lower(channel_id)
+WHERE channel_id <> lower(channel_id);
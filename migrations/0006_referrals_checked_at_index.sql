@@ -0,0 +1,6 @@
+-- migrate:no-transaction
+-- referral_revalidation_job walks referrals oldest-checked first:
+-- WHERE checked_at IS NULL OR checked_at < cutoff ORDER BY checked_at NULLS FIRST LIMIT n
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_referrals_checked_at
+    ON referrals (checked_at NULLS FIRST);
@@ -0,0 +1,12 @@
+-- Resumable slot-3 recount: when the order went live and how far the
+-- current pass over candidate users has got.
+
+ALTER TABLE sponsor_orders ADD COLUMN IF NOT EXISTS placed_at TIMESTAMP NULL;
+
+CREATE TABLE IF NOT EXISTS sponsor_order_recount (
+    order_id INT PRIMARY KEY,
+    last_user_id BIGINT NOT NULL DEFAULT 0,
+    passes INT NOT NULL DEFAULT 0,
+    pass_started_at TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
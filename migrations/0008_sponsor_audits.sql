@@ -0,0 +1,22 @@
+-- Background /audit_sponsor runs: one row per audit, checkpointed per chunk.
+
+CREATE TABLE IF NOT EXISTS sponsor_audits (
+    id SERIAL PRIMARY KEY,
+    channel_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    started_by BIGINT,
+    last_user_id BIGINT NOT NULL DEFAULT 0,
+    total_users INT NOT NULL DEFAULT 0,
+    processed INT NOT NULL DEFAULT 0,
+    members INT NOT NULL DEFAULT 0,
+    resumed_at TIMESTAMP DEFAULT NOW(),
+    processed_at_resume INT NOT NULL DEFAULT 0,
+    error TEXT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    finished_at TIMESTAMP NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sponsor_audits_one_active
+    ON sponsor_audits (channel_id)
+    WHERE status IN ('running', 'paused');
@@ -0,0 +1,30 @@
+-- Persistent broadcasts: one row per /broadcast, one row per recipient.
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    created_by BIGINT,
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    finished_at TIMESTAMP NULL
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INT NOT NULL,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    error_kind TEXT NULL,
+    error TEXT NULL,
+    sent_at TIMESTAMP NULL,
+    PRIMARY KEY (job_id, user_id)
+);
+
+-- broadcast_sender_job: next pending recipients of a job in user_id order
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+    ON broadcast_recipients (job_id, user_id)
+    WHERE status = 'pending';
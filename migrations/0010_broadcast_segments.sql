@@ -0,0 +1,21 @@
+-- migrate:no-transaction
+-- Segmented /broadcast: the draft keeps its filters until an admin
+-- confirms it, and the segment filters get indexes of their own.
+
+ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS filters JSONB NOT NULL DEFAULT '{}'::jsonb;
+ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS segment TEXT NULL;
+
+-- seen=N: last_seen >= now() - N days
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_last_seen
+    ON users (last_seen);
+
+-- activated=1, usually combined with seen=N
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_activated_last_seen
+    ON users (last_seen)
+    WHERE activated = TRUE;
+
+-- level=...: ranges of active_ref_count
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_active_ref_count
+    ON users ((COALESCE(active_ref_count, 0)));
+
+-- balance=N uses idx_users_leaderboard on COALESCE(tickets, 0).
@@ -0,0 +1,11 @@
+-- migrate:no-transaction
+-- Users who blocked the bot (Forbidden / "chat not found" on delivery).
+-- Bulk jobs walk only reachable users; /start clears the flag.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_reachable BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMP NULL;
+
+-- weekly_bonus_all, sponsor audits, broadcast segments: reachable users in user_id order
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_reachable
+    ON users (user_id)
+    WHERE is_reachable = TRUE;
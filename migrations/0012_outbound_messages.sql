@@ -0,0 +1,27 @@
+-- Outbox for notifications: handlers (and the spin server) insert a row,
+-- outbox_dispatcher_job in the bot sends it and retries failures.
+
+CREATE TABLE IF NOT EXISTS outbound_messages (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    parse_mode TEXT NULL,
+    reply_markup JSONB NULL,
+    kind TEXT NOT NULL DEFAULT 'other',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP NULL
+);
+
+-- outbox_dispatcher_job: due messages, oldest first; also backlog size/age
+CREATE INDEX IF NOT EXISTS idx_outbound_messages_due
+    ON outbound_messages (next_attempt_at, id)
+    WHERE status = 'pending';
+
+-- outbox_cleanup_job: sent / failed rows past retention
+CREATE INDEX IF NOT EXISTS idx_outbound_messages_done
+    ON outbound_messages (created_at)
+    WHERE status <> 'pending';
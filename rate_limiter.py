@@ -0,0 +1,233 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+# Lookups do not count towards the per-chat message limits.
+UNMETERED_ENDPOINTS = {
+    "getUpdates",
+    "getMe",
+    "getChat",
+    "getChatMember",
+    "getChatAdministrators",
+    "getChatMemberCount",
+}
+
+# Endpoints that deliver something to a chat; their Forbidden / "chat not
+# found" errors mean the user blocked the bot or deleted the account.
+DELIVERY_ENDPOINT_PREFIXES = ("send", "copyMessage", "forwardMessage")
+
+
+def is_unreachable_error(error):
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token and returns 0 if one is available, otherwise returns
+        # the number of seconds until the next token.
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class ChatBuckets:
+    # Private chats and groups/channels have different limits; buckets that
+    # have refilled completely carry no state and are dropped when the map
+    # grows, so a broadcast to every user does not keep them all alive.
+
+    def __init__(self, private_rate, private_burst, group_per_minute, max_idle=10000):
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_per_minute / 60.0
+        self.max_idle = max_idle
+        self._buckets = {}
+
+    def get(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_idle:
+                self._prune()
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, 1)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id in [key for key, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[chat_id]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _chat_id_of(data):
+    chat_id = (data or {}).get("chat_id")
+    if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+class BotRateLimiter(BaseRateLimiter):
+    # Every Bot API call of the Application goes through process_request().
+    # Pass rate_limit_args={"priority": PRIORITY_BULK} for broadcasts and
+    # other mass sends; they only take a global token while no interactive
+    # request is waiting for one. A RetryAfter pauses all metered traffic
+    # for the requested time and the call is retried up to max_retries times.
+    # on_unreachable(chat_id) is called when a delivery to a private chat
+    # fails because the user can no longer be reached.
+
+    def __init__(
+        self,
+        global_rate=25.0,
+        global_burst=30,
+        private_rate=1.0,
+        private_burst=3,
+        group_per_minute=20,
+        max_retries=3,
+        on_unreachable=None,
+    ):
+        self.max_retries = max_retries
+        self.on_unreachable = on_unreachable
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = ChatBuckets(private_rate, private_burst, group_per_minute)
+        self._paused_until = 0.0
+        self._waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self._global_waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retry_after": 0,
+            "retries": 0,
+            "gave_up": 0,
+            "max_waiting": 0,
+            "unreachable": 0,
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def _wait_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, chat_id, priority):
+        throttled = False
+
+        if chat_id is not None:
+            bucket = self._chats.get(chat_id)
+            while True:
+                await self._wait_pause()
+                delay = bucket.reserve()
+                if not delay:
+                    break
+                throttled = True
+                await asyncio.sleep(delay)
+
+        self._global_waiting[priority] += 1
+        try:
+            while True:
+                await self._wait_pause()
+                if priority == PRIORITY_BULK and self._global_waiting[PRIORITY_INTERACTIVE]:
+                    throttled = True
+                    await asyncio.sleep(0.02)
+                    continue
+                delay = self._global.reserve()
+                if not delay:
+                    break
+                throttled = True
+                await asyncio.sleep(delay)
+        finally:
+            self._global_waiting[priority] -= 1
+
+        if throttled:
+            self.stats["throttled"] += 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_INTERACTIVE
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get("priority", PRIORITY_INTERACTIVE)
+
+        metered = endpoint not in UNMETERED_ENDPOINTS
+        chat_id = _chat_id_of(data)
+        attempt = 0
+
+        self.stats["requests"] += 1
+        self._waiting[priority] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], sum(self._waiting.values()))
+        try:
+            while True:
+                if metered:
+                    await self._acquire(chat_id, priority)
+
+                try:
+                    return await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+                    if attempt >= self.max_retries:
+                        self.stats["gave_up"] += 1
+                        raise
+                    attempt += 1
+                    self.stats["retries"] += 1
+                    if not metered:
+                        await asyncio.sleep(float(e.retry_after))
+                except (BadRequest, Forbidden) as e:
+                    if (
+                        isinstance(chat_id, int)
+                        and chat_id > 0
+                        and endpoint.startswith(DELIVERY_ENDPOINT_PREFIXES)
+                        and is_unreachable_error(e)
+                    ):
+                        self.stats["unreachable"] += 1
+                        if self.on_unreachable:
+                            try:
+                                self.on_unreachable(chat_id)
+                            except Exception as hook_error:
+                                print("on_unreachable error:", hook_error)
+                    raise
+        finally:
+            self._waiting[priority] -= 1
+
+    def snapshot(self):
+        data = dict(self.stats)
+        data.update(
+            {
+                "waiting_interactive": self._waiting[PRIORITY_INTERACTIVE],
+                "waiting_bulk": self._waiting[PRIORITY_BULK],
+                "paused_for": max(0.0, self._paused_until - time.monotonic()),
+                "chat_buckets": len(self._chats),
+            }
+        )
+        return data